@@ -0,0 +1,141 @@
+# asyncio HTTP helper functions for MicroPython (on ESP8266)
+# Copyright (c) 2016 Dries007
+# License: MIT
+
+# Coroutine versions of http.py, so an app can keep serving its sockets and LCD while requests are running.
+# Headers (and the UUID & PYTHON_VERSION from boot.py) are the same as http.py, because they are made by it.
+#
+# Several requests at once:
+#   heads_bodies = await asyncio.gather(http_get(host, 'a'), http_get(host, 'b'))
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import http
+
+
+class Response:
+    """ Like http.Response, but the body is read with the read_chunk and read coroutines. Made by request(). """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.status = None
+        self.headers = {}
+        self.head = None
+        self.chunked = False
+        self.remaining = None
+        self.done = False
+
+    async def _parse(self, keep_head):
+        line = await self.reader.readline()
+        head = [line] if keep_head else None
+        self.status = int(line.split(None, 2)[1])
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if keep_head:
+                head.append(line)
+            k, v = line.split(b':', 1)
+            self.headers[str(k.strip(), 'utf8').lower()] = str(v.strip(), 'utf8')
+        self.head = str(b''.join(head), 'utf8').rstrip() if keep_head else None
+        self.chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+        self.remaining = 0 if self.chunked else (int(self.headers['content-length']) if 'content-length' in self.headers else None)
+        if self.status in (204, 304):
+            self.remaining = 0
+            self.chunked = False
+        self.done = self.remaining == 0 and not self.chunked
+
+    async def read_chunk(self, size=256):
+        """ The next (at most size bytes) part of the body, b'' once it's done. """
+        if self.done:
+            return b''
+        if self.chunked and self.remaining == 0:
+            self.remaining = int((await self.reader.readline()).split(b';', 1)[0], 16)
+            if self.remaining == 0:
+                while (await self.reader.readline()) not in (b'\r\n', b''):  # trailers
+                    pass
+                self.done = True
+                return b''
+        if self.remaining is None:
+            data = await self.reader.read(size)
+        else:
+            data = await self.reader.read(min(size, self.remaining))
+        if not data:
+            self.done = True
+            return b''
+        if self.remaining is not None:
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                if self.chunked:
+                    await self.reader.readline()  # CRLF after the chunk data
+                else:
+                    self.done = True
+        return data
+
+    async def read(self, size=256):
+        """ The whole (rest of the) body as bytes. Only for responses that fit in RAM. """
+        out = bytearray()
+        while True:
+            data = await self.read_chunk(size)
+            if not data:
+                return bytes(out)
+            out += data
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def _request(method, host, url, data, headers, port, keep_head):
+    data = http._body(method, data)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        # Nothing awaits between filling the shared buffer and write(), which copies it, so concurrent requests are fine.
+        mv, n = http._prepare(method, url, http._headers(host, data, headers))
+        if data is not None and not hasattr(data, 'readinto') and n + len(data) <= len(mv):
+            n = http._put(mv, n, data)
+            data = None
+        writer.write(bytes(mv[:n]))
+        if hasattr(data, 'readinto'):
+            while True:
+                part = data.read(512)
+                if not part:
+                    break
+                writer.write(part)
+                await writer.drain()
+        elif data is not None:
+            writer.write(data)
+        await writer.drain()
+        r = Response(reader, writer)
+        await r._parse(keep_head)
+        return r
+    except BaseException:
+        writer.close()
+        raise
+
+
+async def request(method, host, url='/', data='', headers=None, port=80, keep_head=False, timeout=10):
+    """ Send a request, return a Response with the body still to be read. await close() on it when done. """
+    return await asyncio.wait_for(_request(method, host, url, data, headers, port, keep_head), timeout)
+
+
+async def _split(method, host, url, data, headers, port):
+    r = await _request(method, host, url, data, headers, port, True)
+    try:
+        return [r.head, str(await r.read(), 'utf8')]
+    finally:
+        await r.close()
+
+
+async def http_get(host, url, headers=None, port=80, timeout=10):
+    """ Same as http.http_get, timeout (in seconds) covers the whole request. """
+    return await asyncio.wait_for(_split('GET', host, '/%s' % url, '', headers, port), timeout)
+
+
+async def http_post(host, url='/', data='', headers=None, port=80, timeout=10):
+    """ Same as http.http_post, timeout (in seconds) covers the whole request. """
+    return await asyncio.wait_for(_split('POST', host, url, data, headers, port), timeout)
@@ -7,6 +7,7 @@ import micropython
 import network
 import time
 import ds3231
+import clock
 import lcdi2c
 import ubinascii
 import sys
@@ -58,6 +59,7 @@ heating = machine.Pin(PIN_HEATING, machine.Pin.OUT, value=not RELAY_POLARITY)
 cooling = machine.Pin(PIN_COOLING, machine.Pin.OUT, value=not RELAY_POLARITY)
 
 rtc = ds3231.DS3231(i2c)
+wall = clock.Clock(rtc, settings['utc_offset'])
 lcd = lcdi2c.LCD(i2c)
 lcd.init()
 lcd.display_control(True, False, False)
@@ -90,19 +92,22 @@ ap.config(essid=AP_ESSID, password=AP_PASSWD)
 print('Initial setup done')
 
 
+lcd.glyph('heating', (0b00100, 0b01110, 0b11111, 0b00100, 0b00100, 0b00100, 0b00100, 0b00100))
+lcd.glyph('cooling', (0b00100, 0b00100, 0b00100, 0b00100, 0b00100, 0b11111, 0b01110, 0b00100))
+lcd.glyph('idle', (0b00000, 0b00000, 0b00000, 0b11111, 0b11111, 0b00000, 0b00000, 0b00000))
+lcd.glyph('wifi', (0b00000, 0b00000, 0b00000, 0b11100, 0b00010, 0b11001, 0b00101, 0b10101))
+lcd.glyph('no wifi', (0b10001, 0b01010, 0b00100, 0b01010, 0b10001, 0b00000, 0b00000, 0b10000))
+
+
 def lcd_status(line1, line2):
     if not heating():
-        lcd.custom_char(0x00, [0b00100, 0b01110, 0b11111, 0b00100, 0b00100, 0b00100, 0b00100, 0b00100])
+        state = lcd.slot('heating')
     elif not cooling():
-        lcd.custom_char(0x00, [0b00100, 0b00100, 0b00100, 0b00100, 0b00100, 0b11111, 0b01110, 0b00100])
-    else:
-        lcd.custom_char(0x00, [0b00000, 0b00000, 0b00000, 0b11111, 0b11111, 0b00000, 0b00000, 0b00000])
-
-    if wlan.isconnected():
-        lcd.custom_char(0x01, [0b00000, 0b00000, 0b00000, 0b11100, 0b00010, 0b11001, 0b00101, 0b10101])
+        state = lcd.slot('cooling')
     else:
-        lcd.custom_char(0x01, [0b10001, 0b01010, 0b00100, 0b01010, 0b10001, 0b00000, 0b00000, 0b10000])
-    lcd.print(b'%-14s\x00\x01#\n%-16s#' % (line1, line2))
+        state = lcd.slot('idle')
+    wifi = lcd.slot('wifi' if wlan.isconnected() else 'no wifi')
+    lcd.print(b'%-14s%s#\n%-16s#' % (line1, bytes((state, wifi)), line2))
 
 
 def timer_callback(*args):
@@ -127,7 +132,7 @@ def timer_callback(*args):
 
     lcd_count = (lcd_count + 1) % 5
     if lcd_count == 1:
-        lcd_status(b'T Outside', b'%2.2f\xDF' % rtc.temp())
+        lcd_status(b'T Outside', b'%2.2f\xDF' % rtc.temp(max_age=5))
     elif lcd_count == 2:
         lcd_status(b'IP WiFi', wlan.ifconfig()[0] if wlan.isconnected() else 'Not connected')
     elif lcd_count == 3:
@@ -136,7 +141,8 @@ def timer_callback(*args):
         else:
             lcd_status(b'SSID: %s' % AP_ESSID, b'Pass: %s' % AP_PASSWD)
     else:
-        tmp = ds3231.seconds2datetime(ds3231.datetime2seconds(rtc.get_datetime()) + settings['utc_offset'])
+        wall.utc_offset = settings['utc_offset']
+        tmp = wall.datetime()
         lcd_status(b'%02d:%02d' % (tmp[3], tmp[4]), b'%4d-%02d-%02d' % (tmp[0], tmp[1], tmp[2]))
 
 lcd_count = 0
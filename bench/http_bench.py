@@ -0,0 +1,282 @@
+# Host-side benchmarks for http.py
+# Runs the module under CPython with boot.py stubbed out, against a local server.
+#
+# Request side: send calls and bytes allocated per request. Response side: a sweep of body size, chunking and header count,
+# with throughput, latency percentiles and tracemalloc peak. Response results are saved per git revision
+# (bench/results/http-<rev>.json), compare two revisions with:
+#   python bench/http_bench.py --compare bench/results/http-<old rev>.json
+
+import os
+import sys
+import array
+import json
+import time
+import socket
+import threading
+import subprocess
+import tracemalloc
+import socketserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+RESULTS = os.path.join(ROOT, 'bench', 'results')
+
+sys.path.insert(0, os.path.join(ROOT, 'test'))
+from conftest import load  # The same boot stub the tests use
+
+
+def load_http():
+    """ http.py as module 'mpy_http', so it doesn't clash with the standard library. """
+    return load('http.py', 'mpy_http')
+
+
+class Sink:
+    """ Local server that reads and throws away whatever is sent to it. """
+
+    def __init__(self):
+        self.listen = socket.socket()
+        self.listen.bind(('127.0.0.1', 0))
+        self.listen.listen(1)
+        self.port = self.listen.getsockname()[1]
+        self.buf = bytearray(65536)  # recv_into a buffer made up front, so the sink doesn't show up in the allocation numbers
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            c, _ = self.listen.accept()
+            while c.recv_into(self.buf):
+                pass
+            c.close()
+
+
+class Counting:
+    """ Wraps a socket and counts the calls that put data on the wire, with TCP_NODELAY each one is at least one segment. """
+
+    def __init__(self, s):
+        self.s = s
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.s.send(data)
+
+    def sendall(self, data):
+        self.calls += 1
+        return self.s.sendall(data)
+
+
+def legacy_send(s, method, url, headers_, data):
+    """ How http.py used to send a request: one send per line, one bytes() per send. """
+    s.send(bytes('%s %s HTTP/1.1\r\n' % (method, url), 'utf8'))
+    for k, v in headers_.items():
+        s.send(bytes('%s: %s\r\n' % (k, v), 'utf8'))
+    s.send(bytes('\r\n', 'utf8'))
+    if data:
+        s.send(data)
+    s.send(bytes('\r\n', 'utf8'))
+
+
+def measure_send(send, s, *args):
+    """
+    Returns (segments, bytes allocated) for one call of send. Allocated is the total, not the peak: the growth of the
+    traced memory is added up opcode by opcode, so memory that is freed again right away counts as well.
+    Left out is the growth at a call, that's the frame object the tracing makes. Both paths are counted the same way,
+    so CPython's boxed ints (above 256) are in there too, although MicroPython doesn't allocate those.
+    """
+    state = array.array('q', [0, 0])  # allocated, traced memory at the last opcode. An array, so the tracing doesn't allocate.
+
+    def trace(frame, event, arg):
+        frame.f_trace_opcodes = True
+        now = tracemalloc.get_traced_memory()[0]
+        if event != 'call' and now > state[1]:
+            state[0] += now - state[1]
+        state[1] = now
+        return trace
+
+    send(Counting(s), *args)  # Warm up, the first call allocates things that stay (caches)
+    counting = Counting(s)
+    tracemalloc.start()
+    state[1] = tracemalloc.get_traced_memory()[0]
+    sys.settrace(trace)
+    send(counting, *args)
+    sys.settrace(None)
+    tracemalloc.stop()
+    return counting.calls, state[0]
+
+
+def bench_request(http, extra_headers=(0, 4, 16), bodies=(0, 100, 1000, 10000), rounds=50):
+    """ Segments and bytes allocated per request: legacy per-line sending vs the single buffer in http._send """
+    sink = Sink()
+    s = socket.create_connection(('127.0.0.1', sink.port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    print('{:>7} {:>6} | {:>8} {:>9} {:>8} | {:>8} {:>9} {:>8}'.format('Headers', 'Body', 'Segments', 'Alloc B', 'us', 'Segments', 'Alloc B', 'us'))
+    print('{:>7} {:>6} | {:^28} | {:^28}'.format('', '', 'legacy', 'http._send'))
+    for n in extra_headers:
+        for size in bodies:
+            data = b'x' * size if size else None
+            headers_ = http._headers('127.0.0.1', data, {'X-Header-%d' % i: 'value %d' % i for i in range(n)})
+            # The old code had the fixed header values as str
+            legacy = {k: str(v, 'utf8') if isinstance(v, bytes) else v for k, v in headers_.items()}
+            row = []
+            for send, h in ((legacy_send, legacy), (http._send, headers_)):
+                segments, allocated = measure_send(send, s, 'POST', '/api/data', h, data)
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    send(s, 'POST', '/api/data', h, data)
+                row += [segments, allocated, (time.perf_counter() - start) / rounds * 1e6]
+            print('{:7d} {:6d} | {:8d} {:9d} {:8.1f} | {:8d} {:9d} {:8.1f}'.format(n + 5, size, *row))
+    s.close()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """ GET /?size=N&chunk=N&headers=N: size bytes of body, in chunks of chunk bytes (0 = Content-Length), with extra headers. """
+
+    # Whole responses, built once so the server thread doesn't show up in the client's tracemalloc peak.
+    responses = {}
+
+    def handle(self):
+        line = self.rfile.readline()
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+        query = line.split()[1].split(b'?', 1)[1]
+        if query not in self.responses:
+            self.responses[query] = self.build(**{k: int(v) for k, v in (p.split('=') for p in query.decode().split('&'))})
+        self.wfile.write(self.responses[query])
+
+    @staticmethod
+    def build(size, chunk, headers):
+        body = bytes(48 + i % 64 for i in range(size))  # Text, http_get decodes it
+        out = [b'HTTP/1.1 200 OK\r\nConnection: close\r\n']
+        out += [b'X-Bench-%d: %s\r\n' % (i, b'v' * 20) for i in range(headers)]
+        if chunk:
+            out.append(b'Transfer-Encoding: chunked\r\n\r\n')
+            out += [b'%x\r\n%s\r\n' % (len(body[i:i + chunk]), body[i:i + chunk]) for i in range(0, size, chunk)]
+            out.append(b'0\r\n\r\n')
+        else:
+            out.append(b'Content-Length: %d\r\n\r\n' % size)
+            out.append(body)
+        return b''.join(out)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def fetch_get(http, port, url, buf):
+    return len(http.http_get('127.0.0.1', url, port=port)[1])
+
+
+def fetch_stream(http, port, url, buf):
+    n = 0
+    with http.request('GET', '127.0.0.1', '/' + url, port=port) as r:
+        while True:
+            k = r.readinto(buf)
+            if not k:
+                return n
+            n += k
+
+
+def bench_response(http, sizes=(100, 1000, 10000, 100000), chunks=(0, 100, 4096), headers=(0, 16), rounds=50):
+    """ Sweep body size, chunking and header count, for http_get (whole body as str) and request().readinto (streaming). """
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    buf = bytearray(512)
+    results = []
+    print('{:>6} {:>8} {:>7} {:7} | {:>8} {:>8} {:>8} {:>8} {:>9}'.format('Size', 'Chunk', 'Headers', 'Mode', 'MB/s', 'p50 ms', 'p90 ms', 'p99 ms', 'Peak B'))
+    for size in sizes:
+        for chunk in chunks:
+            if chunk >= size:
+                continue
+            for n in headers:
+                url = '?size=%d&chunk=%d&headers=%d' % (size, chunk, n)
+                for mode, fetch in (('get', fetch_get), ('stream', fetch_stream)):
+                    latencies = []
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        fetch(http, port, url, buf)
+                        latencies.append(time.perf_counter() - start)
+                    tracemalloc.start()
+                    fetch(http, port, url, buf)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    result = {'size': size, 'chunk': chunk, 'headers': n, 'mode': mode,
+                              'mb_s': size * rounds / sum(latencies) / 1e6,
+                              'p50_ms': percentile(latencies, 50) * 1e3,
+                              'p90_ms': percentile(latencies, 90) * 1e3,
+                              'p99_ms': percentile(latencies, 99) * 1e3,
+                              'peak_b': peak}
+                    results.append(result)
+                    print('{size:6d} {chunk:8d} {headers:7d} {mode:7} | {mb_s:8.2f} {p50_ms:8.3f} {p90_ms:8.3f} {p99_ms:8.3f} {peak_b:9d}'.format(**result))
+    server.shutdown()
+    server.server_close()
+    return results
+
+
+def revision():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', 'http.py'], cwd=ROOT).returncode != 0
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save(results, path=None):
+    """ Results go in bench/results/http-<git revision>.json, so runs of different revisions can be compared. """
+    rev = revision()
+    path = path or os.path.join(RESULTS, 'http-{}.json'.format(rev))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'revision': rev, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'results': results}, f, indent=1)
+    print('Saved to {}'.format(path))
+
+
+def compare(results, path):
+    """ Change against an earlier run, in %. Positive MB/s and negative ms / bytes are better. """
+    with open(path) as f:
+        old = json.load(f)
+    key = lambda r: (r['size'], r['chunk'], r['headers'], r['mode'])
+    before = {key(r): r for r in old['results']}
+    print('Compared to {} ({})'.format(old['revision'], old['time']))
+    print('{:>6} {:>8} {:>7} {:7} | {:>8} {:>8} {:>8}'.format('Size', 'Chunk', 'Headers', 'Mode', 'MB/s', 'p50', 'Peak'))
+    for r in results:
+        b = before.get(key(r))
+        if b is None:
+            continue
+        delta = lambda k: 100 * (r[k] - b[k]) / b[k] if b[k] else 0
+        print('{:6d} {:8d} {:7d} {:7} | {:+7.1f}% {:+7.1f}% {:+7.1f}%'.format(r['size'], r['chunk'], r['headers'], r['mode'], delta('mb_s'), delta('p50_ms'), delta('peak_b')))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks for http.py, on CPython against a local server.')
+    parser.add_argument('-r', '--rounds', type=int, default=50, help='Requests per timing')
+    parser.add_argument('--only', choices=('request', 'response'), help='Run only one of the benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000], help='Response body sizes')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[0, 100, 4096], help='Chunk sizes, 0 = Content-Length')
+    parser.add_argument('--headers', type=int, nargs='+', default=[0, 16], help='Extra response headers')
+    parser.add_argument('-o', '--output', help='Where to save the response results (default: bench/results/http-<revision>.json)')
+    parser.add_argument('--no-save', action='store_true', help="Don't save the response results")
+    parser.add_argument('-c', '--compare', help='Earlier results file to compare with')
+
+    args = parser.parse_args()
+
+    http = load_http()
+    if args.only != 'response':
+        bench_request(http, rounds=args.rounds)
+    if args.only != 'request':
+        results = bench_response(http, args.sizes, args.chunks, args.headers, args.rounds)
+        if not args.no_save:
+            save(results, args.output)
+        if args.compare:
+            compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+import os
+import ast
+
+
+def rename(module, name):
+    """ Name of a module level symbol once it lives in the bundle. _private stays private, so const() folding still works. """
+    if name.startswith('_'):
+        return '_{}{}'.format(module, name)
+    return '{}_{}'.format(module, name)
+
+
+def _size(node):
+    return len(ast.unparse(node))
+
+
+def _params(node):
+    a = node.args
+    names = {x.arg for x in a.posonlyargs + a.args + a.kwonlyargs}
+    names.update(x.arg for x in (a.vararg, a.kwarg) if x is not None)
+    return names
+
+
+class Renamer(ast.NodeTransformer):
+    """
+    Moves one module into the bundle namespace:
+    its own module level names get the module prefix, and mod.name / from mod import name point at the renamed symbols.
+    """
+
+    def __init__(self, module, own, aliases, names):
+        self.module = module
+        self.own = own
+        self.aliases = aliases
+        self.names = names
+        self.scopes = []
+
+    def _local(self, name):
+        for i, (kind, names) in enumerate(reversed(self.scopes)):
+            # A class body is only visible to itself, not to the methods in it.
+            if kind == 'class' and i != 0:
+                continue
+            if name in names:
+                return True
+        return False
+
+    def _target(self, name):
+        if self._local(name):
+            return None
+        if name in self.names:
+            return self.names[name]
+        if self.module is not None and name in self.own:
+            return rename(self.module, name)
+        if name in self.aliases:
+            raise RuntimeError('Module {} is used as an object, can not be bundled.'.format(self.aliases[name]))
+        return None
+
+    def visit_Name(self, node):
+        target = self._target(node.id)
+        if target is not None:
+            node.id = target
+        return node
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id in self.aliases and not self._local(node.value.id):
+            return ast.copy_location(ast.Name(rename(self.aliases[node.value.id], node.attr), node.ctx), node)
+        self.generic_visit(node)
+        return node
+
+    def visit_Global(self, node):
+        node.names = [self._target(n) or n for n in node.names]
+        return node
+
+    def _function(self, node):
+        if not self.scopes and self.module is not None and hasattr(node, 'name'):
+            node.name = rename(self.module, node.name)
+        if hasattr(node, 'decorator_list'):
+            node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        node.args.defaults = [self.visit(d) for d in node.args.defaults]
+        node.args.kw_defaults = [d if d is None else self.visit(d) for d in node.args.kw_defaults]
+        self.scopes.append(('function', _params(node)))
+        if isinstance(node.body, list):
+            node.body = [self.visit(stmt) for stmt in node.body]
+        else:
+            node.body = self.visit(node.body)
+        self.scopes.pop()
+        return node
+
+    visit_FunctionDef = _function
+    visit_AsyncFunctionDef = _function
+    visit_Lambda = _function
+
+    def visit_ClassDef(self, node):
+        if not self.scopes and self.module is not None:
+            node.name = rename(self.module, node.name)
+        node.bases = [self.visit(n) for n in node.bases]
+        node.decorator_list = [self.visit(n) for n in node.decorator_list]
+        stored = {t.id for stmt in node.body if isinstance(stmt, ast.Assign) for t in stmt.targets if isinstance(t, ast.Name)}
+        self.scopes.append(('class', stored))
+        for stmt in node.body:
+            if isinstance(stmt, ast.Assign):
+                stmt.value = self.visit(stmt.value)
+            else:
+                self.visit(stmt)
+        self.scopes.pop()
+        return node
+
+
+class Bundler:
+    """
+    Merges an app and the modules it imports (found in path) into one module,
+    then drops every module level symbol and method the app can't reach.
+
+    Reachability is by name: a method is kept if an attribute with that name is used anywhere in kept code.
+    That's conservative, but it can't see getattr() or exec() (beer.py's websocket 'exec' command), use keep for those.
+    """
+
+    def __init__(self, path=('drivers',), keep=()):
+        self.path = path
+        self.keep = set(keep)
+        self.modules = {}
+        self.loading = set()
+
+    def find(self, name):
+        for d in self.path:
+            file = os.path.join(d, name + '.py')
+            if os.path.isfile(file):
+                return file
+        return None
+
+    def parse(self, file):
+        with open(file, 'r') as f:
+            return ast.parse(f.read(), file)
+
+    def load(self, name):
+        if name in self.modules or name in self.loading:
+            return
+        self.loading.add(name)
+        self.modules[name] = self.link(self.parse(self.find(name)), name)
+        self.loading.discard(name)
+
+    def public(self, name):
+        return [s._bundle[1] for s in self.modules[name].body if hasattr(s, '_bundle') and not s._bundle[1].startswith('_')]
+
+    def link(self, tree, module=None):
+        """ Resolve imports of bundled modules (loading them first) and move tree into the bundle namespace. """
+        aliases = {}
+        names = {}
+        body = []
+        for stmt in tree.body:
+            if isinstance(stmt, ast.Import):
+                rest = []
+                for a in stmt.names:
+                    if self.find(a.name):
+                        self.load(a.name)
+                        aliases[a.asname or a.name] = a.name
+                    else:
+                        rest.append(a)
+                if rest:
+                    stmt.names = rest
+                    body.append(stmt)
+            elif isinstance(stmt, ast.ImportFrom) and stmt.level == 0 and stmt.module and self.find(stmt.module):
+                self.load(stmt.module)
+                for a in stmt.names:
+                    if a.name == '*':
+                        names.update({n: rename(stmt.module, n) for n in self.public(stmt.module)})
+                    else:
+                        names[a.asname or a.name] = rename(stmt.module, a.name)
+            else:
+                body.append(stmt)
+        tree.body = body
+
+        own = set()
+        for stmt in body:
+            name = None
+            if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = stmt.name
+            elif isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+                name = stmt.targets[0].id
+            if name is not None and module is not None:
+                stmt._bundle = (module, name)
+                own.add(name)
+                if isinstance(stmt, ast.ClassDef):
+                    for m in stmt.body:
+                        if isinstance(m, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                            m._bundle = (module, '{}.{}'.format(name, m.name))
+
+        return Renamer(module, own, aliases, names).visit(tree)
+
+    def bundle(self, app):
+        """ Returns (source of the bundle, report) where report is a list of (symbol, size, kept). """
+        main = self.link(self.parse(app))
+        body = [stmt for tree in self.modules.values() for stmt in tree.body] + main.body
+
+        symbols = {}
+        roots = []
+        for stmt in body:
+            if hasattr(stmt, '_bundle'):
+                symbols.setdefault(stmt.targets[0].id if isinstance(stmt, ast.Assign) else stmt.name, []).append(stmt)
+            else:
+                roots.append(stmt)
+
+        names = set(self.keep)
+        attrs = set(self.keep)
+        scanned = set()
+
+        def scan(node):
+            scanned.add(id(node))
+            for n in ast.walk(node):
+                if isinstance(n, ast.Name):
+                    names.add(n.id)
+                elif isinstance(n, ast.Attribute):
+                    attrs.add(n.attr)
+
+        def wanted(method):
+            return method.name in attrs or (method.name.startswith('__') and method.name.endswith('__'))
+
+        for stmt in roots:
+            scan(stmt)
+        done = False
+        while not done:
+            done = True
+            for name in list(names):
+                for stmt in symbols.get(name, ()):
+                    if isinstance(stmt, ast.ClassDef):
+                        if id(stmt) not in scanned:
+                            scanned.add(id(stmt))
+                            for n in stmt.bases + stmt.decorator_list + [m for m in stmt.body if not hasattr(m, '_bundle')]:
+                                scan(n)
+                            done = False
+                        for m in stmt.body:
+                            if hasattr(m, '_bundle') and id(m) not in scanned and wanted(m):
+                                scan(m)
+                                done = False
+                    elif id(stmt) not in scanned:
+                        scan(stmt)
+                        done = False
+
+        report = []
+        out = []
+        for stmt in body:
+            if not hasattr(stmt, '_bundle'):
+                out.append(stmt)
+                continue
+            kept = id(stmt) in scanned
+            if isinstance(stmt, ast.ClassDef):
+                methods = [m for m in stmt.body if hasattr(m, '_bundle')]
+                report.append(('.'.join(stmt._bundle), _size(stmt) - sum(_size(m) for m in methods), kept))
+                for m in methods:
+                    report.append(('.'.join(m._bundle), _size(m), kept and id(m) in scanned))
+                stmt.body = [m for m in stmt.body if not hasattr(m, '_bundle') or id(m) in scanned] or [ast.Pass()]
+            else:
+                report.append(('.'.join(stmt._bundle), _size(stmt), kept))
+            if kept:
+                out.append(stmt)
+
+        # One copy of each plain import is enough.
+        seen = set()
+        imports = []
+        for stmt in out:
+            if isinstance(stmt, ast.Import):
+                stmt.names = [a for a in stmt.names if (a.name, a.asname) not in seen]
+                seen.update((a.name, a.asname) for a in stmt.names)
+                if not stmt.names:
+                    continue
+            imports.append(stmt)
+
+        return ast.unparse(ast.fix_missing_locations(ast.Module(imports, []))), report
+
+
+def print_report(report):
+    print('{:40} {:>6}  {}'.format('Symbol', 'Bytes', 'Result'))
+    for symbol, size, kept in report:
+        print('{:40} {:6d}  {}'.format(symbol, size, 'kept' if kept else 'dropped'))
+    kept = sum(size for _, size, k in report if k)
+    dropped = sum(size for _, size, k in report if not k)
+    print('Kept {} bytes, dropped {} bytes ({:.0f}%)'.format(kept, dropped, 100 * dropped / (kept + dropped) if kept + dropped else 0))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Bundle an app and its drivers into one module, without the unused parts.')
+
+    parser.add_argument('app', help='App entry point, eg apps/beer.py')
+    parser.add_argument('-o', '--output', help='Output file (default: print the bundle)')
+    parser.add_argument('-p', '--path', nargs='*', default=['drivers'], help='Where to look for modules to bundle')
+    parser.add_argument('-k', '--keep', nargs='*', default=[], help='Names to keep even if nothing uses them (for getattr/exec)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='No size report')
+
+    args = parser.parse_args()
+
+    source, report = Bundler(args.path, args.keep).bundle(args.app)
+
+    if not args.quiet:
+        print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(source)
+    elif args.quiet:
+        print(source)
+
+if __name__ == '__main__':
+    main()
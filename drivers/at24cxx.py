@@ -4,33 +4,159 @@
 #
 # Only tested with AT24C32
 
+import time
+
 
 class AT24CXX:
+    """
+    page is the page size of the part: 32 for the AT24C32/64, 64 for the AT24C128/256, 128 for the AT24C512.
+    Writes of any length are split on page boundaries. After a page the chip is busy writing it (up to 5 ms, during
+    which it doesn't ACK), the next access polls for the ACK instead of sleeping a fixed time.
+
+    It's also a block device (size bytes, in blocks of block_size), so it can hold a filesystem:
+        uos.VfsLfs2.mkfs(eeprom)
+        uos.mount(uos.VfsLfs2(eeprom), '/eeprom')
+    (FAT needs block_size=512 and more blocks than an AT24C32 has.)
+    Block writes go into a write-back cache of cache blocks, only the pages that changed are written, on sync or
+    when a block is evicted. Don't mix write() with writeblocks() on the same blocks, write() doesn't see the cache.
+    """
 
-    def __init__(self, i2c, address=0x57, check=True):
+    def __init__(self, i2c, address=0x57, check=True, page=32, size=4096, block_size=128, cache=1):
         self.i2c = i2c
         self.address = address
+        self.page = page
+        self.size = size
+        self.block_size = block_size
+        self.cache = cache
+        self._cache = []  # [block, data, dirty pages (bit n = page n of the block)], least recently used first
+        self._busy = False
+        self._address = bytearray(2)
         if check and address not in i2c.scan():
             raise Exception('AT24CXX init failed: No device on address %x' % address)
 
+    def wait(self, timeout_ms=20):
+        """ Wait until the last write cycle is done: the chip ACKs its address again. """
+        if not self._busy:
+            return
+        start = time.ticks_ms()
+        while True:
+            try:
+                self.i2c.writeto(self.address, b'')
+                break
+            except OSError:
+                if time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                    raise Exception('AT24CXX write timeout: No ACK after %d ms' % timeout_ms)
+        self._busy = False
+
     def write_byte(self, address, data):
-        self.i2c.start()
-        self.i2c.write(bytes((self.address << 1, (address >> 8) & 0xFF, address & 0xFF, data)))
-        self.i2c.stop()
+        self.write(address, bytes((data,)))
 
     def write(self, address, data):
-        if len(data) > 32: raise Exception("Can't write more then 32 bytes at one time.")
-        self.i2c.start()
-        self.i2c.write(bytes((self.address << 1, (address >> 8) & 0xFF, address & 0xFF)))
-        self.i2c.write(data)
-        self.i2c.stop()
+        """ Write data (anything with the buffer protocol, of any length) starting at address. """
+        mv = memoryview(data)
+        i = 0
+        while i < len(mv):
+            n = min(len(mv) - i, self.page - (address + i) % self.page)
+            self.wait()
+            self.i2c.writeto_mem(self.address, address + i, mv[i:i + n], addrsize=16)
+            self._busy = True
+            i += n
 
     def read(self, address, size):
         self.write_address(address)
         return self.read_sequential(size)
 
+    def readinto(self, address, buf):
+        """ Read len(buf) bytes starting at address into buf, without allocating. """
+        self.write_address(address)
+        self.read_sequential_into(buf)
+
     def write_address(self, address):
-        self.i2c.writeto(self.address, bytes(((address >> 8) & 0xFF, address & 0xFF)))
+        self.wait()
+        self._address[0] = (address >> 8) & 0xFF
+        self._address[1] = address & 0xFF
+        self.i2c.writeto(self.address, self._address)
 
     def read_sequential(self, size):
+        self.wait()
         return self.i2c.readfrom(self.address, size)
+
+    def read_sequential_into(self, buf):
+        self.wait()
+        self.i2c.readfrom_into(self.address, buf)
+
+    def _block(self, n, load=True):
+        """ Cache entry of block n. Evicts (and writes) the least recently used block if the cache is full. """
+        for entry in self._cache:
+            if entry[0] == n:
+                self._cache.remove(entry)
+                self._cache.append(entry)
+                return entry
+        if len(self._cache) >= self.cache:
+            entry = self._cache.pop(0)
+            self._flush(entry)
+        else:
+            entry = [0, bytearray(self.block_size), 0]
+        entry[0] = n
+        if load:
+            self.readinto(n * self.block_size, entry[1])
+        self._cache.append(entry)
+        return entry
+
+    def _flush(self, entry):
+        """ Write the dirty pages of a cache entry, runs of them in one write(). """
+        dirty = entry[2]
+        mv = memoryview(entry[1])
+        address = entry[0] * self.block_size
+        i = 0
+        while dirty >> i:
+            if not dirty >> i & 1:
+                i += 1
+                continue
+            j = i
+            while dirty >> j & 1:
+                j += 1
+            self.write(address + i * self.page, mv[i * self.page:j * self.page])
+            i = j
+        entry[2] = 0
+
+    def sync(self):
+        for entry in self._cache:
+            self._flush(entry)
+
+    def readblocks(self, n, buf, offset=0):
+        """ Straight into buf, with the changes that are still in the cache on top. """
+        mv = memoryview(buf)
+        address = n * self.block_size + offset
+        self.readinto(address, buf)
+        for block, data, dirty in self._cache:
+            if not dirty:
+                continue
+            start = max(address, block * self.block_size)
+            end = min(address + len(mv), (block + 1) * self.block_size)
+            if start < end:
+                mv[start - address:end - address] = memoryview(data)[start - block * self.block_size:end - block * self.block_size]
+
+    def writeblocks(self, n, buf, offset=0):
+        mv = memoryview(buf)
+        address = n * self.block_size + (offset or 0)
+        i = 0
+        while i < len(mv):
+            block, start = divmod(address + i, self.block_size)
+            k = min(len(mv) - i, self.block_size - start)
+            entry = self._block(block, k < self.block_size)
+            entry[1][start:start + k] = mv[i:i + k]
+            # Pages start // page up to (start + k - 1) // page are dirty now.
+            entry[2] |= (1 << ((start + k - 1) // self.page + 1)) - (1 << (start // self.page))
+            i += k
+
+    def ioctl(self, op, arg):
+        if op == 2 or op == 3:  # deinit, sync
+            self.sync()
+            return 0
+        if op == 4:  # block count
+            return self.size // self.block_size
+        if op == 5:  # block size
+            return self.block_size
+        if op == 1 or op == 6:  # init, erase (an EEPROM doesn't need erasing)
+            return 0
@@ -0,0 +1,114 @@
+# Wall clock for MicroPython (on ESP8266)
+# Copyright (c) 2016 Dries007
+# License: MIT
+
+# To be used in combo with ds3231.py
+#
+# Reads the DS3231 once, then counts on with time.ticks_ms. Only every resync seconds there is I2C traffic again.
+# Times are seconds since 2000-01-01 (the MicroPython epoch), with utc_offset added. Valid from 2000 to 2099 (same as the DS3231).
+#
+# Example:
+#   clock = Clock(ds3231.DS3231(i2c), utc_offset=3600)
+#   year, month, day, hour, minute, second, weekday = clock.datetime()
+
+import time
+
+_CALENDAR = const(0x00)
+
+# Days before the first of each month, in a year that is not a leap year.
+_MONTHS = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+
+def _bcd2bin(value):
+    return value - 6 * (value >> 4)
+
+
+def datetime2seconds(year, month, day, hour=0, minute=0, second=0):
+    y = year - 2000
+    days = 365 * y + (y + 3) // 4 + _MONTHS[month - 1] + day - 1
+    if month > 2 and not y % 4:
+        days += 1
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+
+def bcd2seconds(buffer):
+    """ The 7 calendar registers (second first), as read from the DS3231, to seconds. No mktime. """
+    return datetime2seconds(_bcd2bin(buffer[6]) + 2000, _bcd2bin(buffer[5]), _bcd2bin(buffer[4]), _bcd2bin(buffer[2]), _bcd2bin(buffer[1]), _bcd2bin(buffer[0]))
+
+
+def seconds2datetime(sec):
+    """ Seconds to (year, month, day, hour, minute, second, weekday), weekday 0 = monday. No localtime. """
+    days, sec = divmod(sec, 86400)
+    weekday = (days + 5) % 7  # 2000-01-01 was a saturday
+    year, days = divmod(days, 1461)  # 4 year cycles, the first year is a leap year
+    year = 2000 + 4 * year
+    leap = days < 366
+    if not leap:
+        days -= 366
+        year += 1 + days // 365
+        days %= 365
+    month = 1
+    while month < 12 and days >= _MONTHS[month] + (leap and month >= 2):
+        month += 1
+    day = days - _MONTHS[month - 1] - (leap and month > 2) + 1
+    return year, month, day, sec // 3600, sec // 60 % 60, sec % 60, weekday
+
+
+class Clock:
+    """
+    Cached wall clock on top of a DS3231. time(), datetime() and timestamp() don't touch the bus,
+    except when the last sync is more than resync seconds ago. set_rtc also keeps machine.RTC (boot.timestamp) in step.
+    ticks_ms wraps after a few days on the ESP8266, so resync is capped to a day. If nothing asked for the time in so long
+    that ticks_diff comes out negative (about 6 days), that's a resync too.
+    """
+
+    def __init__(self, rtc, utc_offset=0, resync=3600, set_rtc=False):
+        self.rtc = rtc
+        self.utc_offset = utc_offset
+        self.resync = min(resync, 86400)
+        self.set_rtc = set_rtc
+        self.syncs = 0
+        self._buffer = bytearray(7)
+        self._base = 0  # UTC seconds at _ticks
+        self._ticks = 0
+        self.sync()
+
+    def sync(self):
+        """ Read the DS3231 (one 7 byte read) and count on from there. """
+        self.rtc.i2c.readfrom_mem_into(self.rtc.address, _CALENDAR, self._buffer)
+        ticks = time.ticks_ms()
+        seconds = bcd2seconds(self._buffer)
+        elapsed = time.ticks_diff(ticks, self._ticks) // 1000
+        if self.syncs and elapsed >= 0 and self._base + elapsed == seconds:
+            # Still in step: keep the part of a second the DS3231 can't tell us.
+            self._ticks = time.ticks_add(self._ticks, elapsed * 1000)
+        else:
+            self._ticks = ticks
+        self._base = seconds
+        self.syncs += 1
+        if self.set_rtc:
+            import machine
+            dt = seconds2datetime(seconds)
+            machine.RTC().datetime(dt[0:3] + (dt[6],) + dt[3:6] + (0,))
+
+    def _ms(self):
+        elapsed = time.ticks_diff(time.ticks_ms(), self._ticks)
+        if not 0 <= elapsed < self.resync * 1000:
+            self.sync()
+            elapsed = time.ticks_diff(time.ticks_ms(), self._ticks)
+        return elapsed
+
+    def time(self):
+        """ Local time, in seconds since 2000-01-01. """
+        ms = self._ms()  # May sync, which moves _base
+        return self._base + ms // 1000 + self.utc_offset
+
+    def datetime(self):
+        """ Local (year, month, day, hour, minute, second, weekday), same as DS3231.get_datetime. """
+        return seconds2datetime(self.time())
+
+    def timestamp(self):
+        """ Local time as 'YYYY-MM-DD HH:MM:SS.mmm', like boot.timestamp. """
+        ms = self._ms()
+        dt = seconds2datetime(self._base + ms // 1000 + self.utc_offset)
+        return '%02d-%02d-%02d %02d:%02d:%02d.%03d' % (dt[0:6] + (ms % 1000,))
@@ -2,10 +2,12 @@
 # Copyright (c) 2016 Dries007
 # License: MIT
 #
-# Removed functionality:
-#   Alarm 2 (Module became too big to be imported)
+# Alarm 1, alarm 2, control and status (0x07 -> 0x0F) are kept in a shadow copy. Setters write it right away, in a
+# transaction (with rtc: ...) everything goes out in one write on exit, or is dropped if the block raised.
+# The bits the chip changes by itself (CONV, BSY & the flags) are always read from the chip.
+# Use invalidate() if something else wrote the chip.
 #
-# ToDo: add back alarm 2 & test in frozen bytecode (aka preloaded modules)
+# ToDo: test in frozen bytecode (aka preloaded modules)
 #
 
 import time
@@ -16,7 +18,6 @@ _BIT1 = const(1 << 1)
 _BIT2 = const(1 << 2)
 _BIT3 = const(1 << 3)
 _BIT4 = const(1 << 4)
-_BIT5 = const(1 << 5)
 _BIT6 = const(1 << 6)
 _BIT7 = const(1 << 7)
 
@@ -28,6 +29,15 @@ _STATUS = const(0x0F)
 _AGING = const(0x10)
 _TEMP = const(0x11)
 
+_SHADOW = const(0x07)
+_SHADOW_SIZE = const(9)
+_CONV = const(1 << 5)  # Control: start a temperature conversion, the chip clears it when done.
+_AXM = const(1 << 7)  # Alarm: the match bit, in every alarm register
+_DYDT = const(1 << 6)  # Alarm: day/date register matches the weekday (1) or the day of the month (0)
+_TIME = const(0x7F)  # Alarm: second, minute or hour in BCD
+_DAY_DATE = const(0x3F)  # Alarm: day/date in BCD
+_FLAGS = const(0b10000011)  # Status: OSF, A2F & A1F. Only a 0 can be written, writing a 1 leaves them as they are.
+
 
 def _bcd2bin(value):
     return value - 6 * (value >> 4)
@@ -37,17 +47,6 @@ def _bin2bcd(value):
     return value + 6 * (value // 10)
 
 
-def _twocplm2int(val, bits=8):
-    if (val & (1 << (bits - 1))) != 0: val -= 1 << bits
-    return val
-
-
-def _int2twocplm(val):
-    mask = (1 << 7)
-    if val >= 0: return val
-    return mask | (mask + val)
-
-
 def datetime2seconds(datetime):
     return time.mktime(datetime + (0,))
 
@@ -62,34 +61,62 @@ class DS3231:
     Datetime tuple = (year, month, day, hour, minute, second, weekday)
     """
 
+    _depth = 0
+    _dirty = False
+    _temp = None  # Last (temperature, ticks_ms) read
+
     def __init__(self, i2c, address=0x68, check=True):
         self.i2c = i2c
         self.address = address
         if check and address not in i2c.scan():
             raise Exception('DS3231 init failed: No device on address %x' % address)
-        if self._bit(_STATUS, _BIT7):
+        self.invalidate()
+        if self._read(_STATUS)[0] & _BIT7:
             print("Oscillator Stop Flag is set. The RTC time may be in-accurate.")
-        if self._bit(_CONTROL, _BIT7, False):
-            print("Oscillator was not running. Stop flag has now been cleared.")
+        if self._shadow[_CONTROL - _SHADOW] & _BIT7:
+            self._field(_CONTROL, _BIT7, 0)
+            print("Oscillator was stopped, it has been started.")
 
     def _read(self, register, length=1):
-        buf = self.i2c.readfrom_mem(self.address, register, length)
-        return buf[0] if length == 1 else buf
+        return self.i2c.readfrom_mem(self.address, register, length)
 
     def _write(self, register, data):
         self.i2c.writeto_mem(self.address, register, data)
 
-    def _bit(self, register, mask, value=None):
-        register_data = self._read(register)
-        old = bool(mask & register_data)
-        if value is None:
-            return old
-        if value:
-            register_data |= mask
-        else:
-            register_data &= ~mask
-        self._write(register, bytes((register_data,)))
-        return old
+    # Stage the bits in mask of a shadowed register (value is already shifted in place)
+    def _field(self, register, mask, value):
+        s = self._shadow
+        i = register - _SHADOW
+        s[i] = s[i] & ~mask | value & mask
+        self._dirty = True
+        if not self._depth:
+            self.commit()
+
+    def _bit(self, register, mask, value):
+        self._field(register, mask, mask if value else 0)
+
+    def invalidate(self):
+        self.commit(False)
+
+    # Write the staged changes, write=False drops them (reads the shadow from the chip again)
+    def commit(self, write=True):
+        if not write:
+            self._shadow = bytearray(self._read(_SHADOW, _SHADOW_SIZE))
+        elif self._dirty:
+            self._write(_SHADOW, self._shadow)
+        # CONV is kept 0 and the flags 1 in the shadow, so writing it back changes neither.
+        self._shadow[_CONTROL - _SHADOW] &= ~_CONV
+        self._shadow[_STATUS - _SHADOW] |= _FLAGS
+        self._dirty = False
+
+    def __enter__(self):
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self._depth -= 1
+        if not self._depth:
+            self.commit(exc_type is None)
 
     def get_datetime(self):
         buffer = self._read(_CALENDAR, 7)
@@ -128,38 +155,81 @@ class DS3231:
         self.set_datetime(*seconds2datetime(sec))
         self.sync()
 
-    def temp(self, force=False):
-        """ Get temperature. This function waits until the RTC is ready. By default the chip does 1 read evey 64 seconds. (You can force an update.) """
-        if force:
-            self._bit(_CONTROL, _BIT5, True)
-            while self._bit(_CONTROL, _BIT5):
-                time.sleep_ms(1)
-        while self._bit(_STATUS, _BIT2):
-            time.sleep_ms(1)
+    # Temperature without blocking: start_temp(), poll temp_busy(), then read_temp()
+    def start_temp(self):
+        if not self.temp_busy():
+            self._field(_CONTROL, _CONV, _CONV)
+
+    def temp_busy(self):
+        buffer = self._read(_CONTROL, 2)
+        return (buffer[0] & _CONV | buffer[1] & _BIT2) > 0
+
+    def read_temp(self):
         buffer = self._read(_TEMP, 2)
-        return _twocplm2int((buffer[0] << 2) + (buffer[1] >> 6), 10) * 0.25
+        value = buffer[0] << 8 | buffer[1]  # Two's complement, in 1/256 degrees
+        self._temp = value = (value - (value & 0x8000) * 2) / 256, time.ticks_ms()
+        return value[0]
 
-    def get_alarm1(self, reset=True):
-        """Get the alarm 1 flag, and reset it by default"""
-        return self._bit(_STATUS, _BIT0, False if reset else None)
+    # (temperature, age in ms) of the last reading, or None
+    def last_temp(self):
+        if self._temp:
+            return self._temp[0], time.ticks_diff(time.ticks_ms(), self._temp[1])
 
-    def get_alarm_time_1(self):
-        """Return: day_date, hour, minute, second, mask"""
-        buffer = self._read(_ALARM1, 4)
-        mask = (  # = A1M1 | A1M2 << 1 | A1M3 << 2 | A1M4 << 3 | DY/DT << 4
-            (buffer[0] & _BIT7) >> 7 |  # A1M1
-            (buffer[1] & _BIT7) >> 6 |  # A1M2
-            (buffer[2] & _BIT7) >> 5 |  # A1M3
-            (buffer[3] & _BIT7) >> 4 |  # A1M4
-            (buffer[3] & _BIT6) >> 2)  # DY/DT
-        second = _bcd2bin(buffer[0] & ~_BIT7)
-        minute = _bcd2bin(buffer[1] & ~_BIT7)
-        hour = _bcd2bin(buffer[2] & ~_BIT7)
-        day_date = _bcd2bin(buffer[3] & ~_BIT7 & ~_BIT6)
-        return day_date, hour, minute, second, mask
+    def temp(self, force=False, max_age=None):
+        """ Get temperature. This function waits until the RTC is ready. By default the chip does 1 read evey 64 seconds. (You can force an update.) """
+        # A reading younger than max_age seconds is returned without touching the bus.
+        last = self.last_temp()
+        if not (max_age and last and last[1] < max_age * 1000):
+            if force:
+                self.start_temp()
+            while self.temp_busy():
+                time.sleep_ms(1)
+            self.read_temp()
+        return self._temp[0]
+
+    async def temp_async(self, force=False, poll_ms=10):
+        """ Same as temp(), but awaits (polling every poll_ms) instead of blocking. """
+        try:
+            import uasyncio as asyncio
+        except ImportError:
+            import asyncio
+        if force:
+            self.start_temp()
+        while self.temp_busy():
+            await asyncio.sleep(poll_ms / 1000)
+        return self.read_temp()
+
+    def get_alarm(self, n, reset=True):
+        """Get the alarm n flag, and reset it by default"""
+        old = bool(self._read(_STATUS)[0] & n)  # A1F = bit 0, A2F = bit 1
+        if reset and old:
+            self._field(_STATUS, n, 0)
+        return old
 
-    def set_alarm_time_1(self, mask=None, second=None, minute=None, hour=None, day_date=None):
+    def get_alarm_time(self, n):
         """
+        Return: day_date, hour, minute, second, mask for alarm 1
+                day_date, hour, minute, mask for alarm 2 (it has no seconds)
+        """
+        s = self._shadow
+        i = (_ALARM1 + 1 if n == 1 else _ALARM2) - _SHADOW  # The minute register, both alarms are the same from there on
+        mask = (  # = AxM2 << 1 | AxM3 << 2 | AxM4 << 3 | DY/DT << 4
+            (s[i] & _AXM) >> 6 |  # AxM2
+            (s[i + 1] & _AXM) >> 5 |  # AxM3
+            (s[i + 2] & _AXM) >> 4 |  # AxM4
+            (s[i + 2] & _DYDT) >> 2)  # DY/DT
+        minute = _bcd2bin(s[i] & _TIME)
+        hour = _bcd2bin(s[i + 1] & _TIME)
+        day_date = _bcd2bin(s[i + 2] & _DAY_DATE)
+        if n == 2:
+            return day_date, hour, minute, mask
+        buffer = s[_ALARM1 - _SHADOW]
+        second = _bcd2bin(buffer & _TIME)
+        return day_date, hour, minute, second, mask | (buffer & _AXM) >> 7  # A1M1
+
+    def set_alarm_time(self, n, mask=None, second=None, minute=None, hour=None, day_date=None):
+        """
+        Set alarm n, the changed registers go out in one write. second is ignored for alarm 2.
         mask is 5 bit field made like this: AxM1 | AxM2 << 1 | AxM3 << 2 | AxM4 << 3 | DY/DT << 4
         AxM1 is ony available on alarm 1.
         The mask bits (M1 -> M4) determine what needs to match for an alarm to occur.
@@ -172,71 +242,62 @@ class DS3231:
         DY/DT set to 0 means the day/date field must match the date (day of month)
                      1 means the day/date field must match the day (day of week)
         """
-        if mask is not None:
-            self._bit(_ALARM1 + 0, _BIT7, mask & _BIT0)  # A1M1
-            self._bit(_ALARM1 + 1, _BIT7, mask & _BIT1)  # A1M2
-            self._bit(_ALARM1 + 2, _BIT7, mask & _BIT2)  # A1M3
-            self._bit(_ALARM1 + 3, _BIT7, mask & _BIT3)  # A1M4
-            self._bit(_ALARM1 + 3, _BIT6, mask & _BIT4)  # DY/DT
-        if second is not None: self._write(_ALARM1 + 0, bytes(((self._read(_ALARM1 + 0) & _BIT7) + _bin2bcd(second),)))  # A1M1 << 7 | second in BCD
-        if minute is not None: self._write(_ALARM1 + 1, bytes(((self._read(_ALARM1 + 1) & _BIT7) + _bin2bcd(minute),)))  # A1M2 << 7 | minute in BCD
-        if hour is not None: self._write(_ALARM1 + 2, bytes(((self._read(_ALARM1 + 2) & _BIT7) + _bin2bcd(hour),)))  # A1M3 << 7 | hour in BCD
-        if day_date is not None: self._write(_ALARM1 + 3, bytes(((self._read(_ALARM1 + 3) & 0b11000000) + _bin2bcd(day_date),)))  # A1M3 << 7 | DY/DT << 6 | day/date in BCD
-
-    #
-    # def get_alarm2(self, reset=True):
-    #     """Get the alarm 1 flag, and reset it by default"""
-    #     return self._bit(_STATUS, _BIT1, True if reset else None)
-    #
-    # def get_alarm_time_2(self):
-    #     """Return: day_date, hour, minute, mask"""
-    #     buffer = self._read(_ALARM2, 3)
-    #     mask = (  # = A2M2 << 1 | A2M3 << 2 | A2M4 << 3 | DY/DT << 4; A2M1 does not exist.
-    #         (buffer[0] & _BIT7) >> 6 |  # A2M2
-    #         (buffer[1] & _BIT7) >> 5 |  # A2M3
-    #         (buffer[2] & _BIT7) >> 4 |  # A2M4
-    #         (buffer[2] & _BIT6) >> 5  # DY/DT
-    #     )
-    #     minute = _bcd2bin(buffer[0] & ~_BIT7)
-    #     hour = _bcd2bin(buffer[1] & ~_BIT7)
-    #     day_date = _bcd2bin(buffer[2] & ~_BIT7 & ~_BIT6)
-    #     return day_date, hour, minute, mask
-    #
-    # def set_alarm_time_2(self, mask=None, minute=None, hour=None, day_date=None):
-    #     """See set_alarm_time_1"""
-    #     if mask is not None:
-    #         self._bit(_ALARM2 + 0, _BIT7, mask & _BIT1)  # A1M2
-    #         self._bit(_ALARM2 + 1, _BIT7, mask & _BIT2)  # A1M3
-    #         self._bit(_ALARM2 + 2, _BIT7, mask & _BIT3)  # A1M4
-    #         self._bit(_ALARM2 + 2, _BIT6, mask & _BIT4)  # DY/DT
-    #     if minute is not None: self._write(_ALARM2 + 0, bytes(((self._read(_ALARM2 + 0) & _BIT7) + _bin2bcd(minute),)))  # A2M2 << 7 | minute in BCD
-    #     if hour is not None: self._write(_ALARM2 + 1, bytes(((self._read(_ALARM2 + 1) & _BIT7) + _bin2bcd(hour),)))  # A2M2 << 7 | hour in BCD
-    #     if day_date is not None: self._write(_ALARM2 + 2, bytes(((self._read(_ALARM2 + 2) & _BIT7) + _bin2bcd(day_date),)))  # A2M2 << 7 | DY/DT << 6 |
-    # day/date in BCD
+        register = _ALARM1 + 1 if n == 1 else _ALARM2  # The minute register, both alarms are the same from there on
+        with self:
+            if n == 1:
+                if mask is not None: self._field(_ALARM1, _AXM, mask << 7)  # A1M1
+                if second is not None: self._field(_ALARM1, _TIME, _bin2bcd(second))
+            if mask is not None:
+                self._field(register + 0, _AXM, mask << 6)  # AxM2
+                self._field(register + 1, _AXM, mask << 5)  # AxM3
+                self._field(register + 2, _AXM, mask << 4)  # AxM4
+                self._field(register + 2, _DYDT, mask << 2)  # DY/DT
+            if minute is not None: self._field(register + 0, _TIME, _bin2bcd(minute))
+            if hour is not None: self._field(register + 1, _TIME, _bin2bcd(hour))
+            if day_date is not None: self._field(register + 2, _DAY_DATE, _bin2bcd(day_date))
+
+    def get_alarm1(self, reset=True):
+        return self.get_alarm(1, reset)
+
+    def get_alarm2(self, reset=True):
+        return self.get_alarm(2, reset)
+
+    def get_alarm_time_1(self):
+        return self.get_alarm_time(1)
+
+    def get_alarm_time_2(self):
+        return self.get_alarm_time(2)
+
+    def set_alarm_time_1(self, mask=None, second=None, minute=None, hour=None, day_date=None):
+        self.set_alarm_time(1, mask, second, minute, hour, day_date)
+
+    def set_alarm_time_2(self, mask=None, minute=None, hour=None, day_date=None):
+        """See set_alarm_time"""
+        self.set_alarm_time(2, mask, None, minute, hour, day_date)
 
     def get_config(self):
-        buffer = self._read(_CONTROL, 2)
+        buffer = (self._shadow[_CONTROL - _SHADOW], self._shadow[_STATUS - _SHADOW])
         return (bool(buffer[0] & _BIT7),  # EOSC
                 bool(buffer[0] & _BIT6),  # BBSQW
                 (buffer[0] & (_BIT4 | _BIT3)) >> 3,  # RS
                 bool(buffer[0] & _BIT2),  # INTCN
-                # bool(buffer[0] & _BIT1),  # A2IE
+                bool(buffer[0] & _BIT1),  # A2IE
                 bool(buffer[0] & _BIT0),  # A1IE
-                bool(buffer[1] & _BIT3))  # EN32kHz)
-
-    def set_config(self, eosc=None, bbsqw=None, rs=None, intcn=None, a1ie=None, en32khz=None):  # a2ie=None,
-        if eosc is not None: self._bit(_CONTROL, _BIT7, eosc)
-        if bbsqw is not None: self._bit(_CONTROL, _BIT6, bbsqw)
-        if rs is not None:
-            self._bit(_CONTROL, _BIT4, rs >> 1)
-            self._bit(_CONTROL, _BIT3, rs & 1)
-        if intcn is not None: self._bit(_CONTROL, _BIT2, intcn)
-        # if a2ie is not None: self._bit(_CONTROL, _BIT1, a2ie)
-        if a1ie is not None: self._bit(_CONTROL, _BIT0, a1ie)
-        if en32khz is not None: self._bit(_STATUS, _BIT3, en32khz)
+                bool(buffer[1] & _BIT3))  # EN32kHz
+
+    def set_config(self, eosc=None, bbsqw=None, rs=None, intcn=None, a1ie=None, en32khz=None, a2ie=None):
+        with self:
+            if eosc is not None: self._bit(_CONTROL, _BIT7, eosc)
+            if bbsqw is not None: self._bit(_CONTROL, _BIT6, bbsqw)
+            if rs is not None: self._field(_CONTROL, _BIT4 | _BIT3, rs << 3)
+            if intcn is not None: self._bit(_CONTROL, _BIT2, intcn)
+            if a2ie is not None: self._bit(_CONTROL, _BIT1, a2ie)
+            if a1ie is not None: self._bit(_CONTROL, _BIT0, a1ie)
+            if en32khz is not None: self._bit(_STATUS, _BIT3, en32khz)
 
     def age_offset(self, value=None):
         """ Something magical I don't quite understand. See DS3231 datasheet. """
         if value is None:
-            return _twocplm2int(self._read(_AGING))
-        self._write(_AGING, bytes((_int2twocplm(value),)))
+            value = self._read(_AGING)[0]
+            return value - (value & 0x80) * 2  # Two's complement
+        self._write(_AGING, bytes((value & 0xFF,)))
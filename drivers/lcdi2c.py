@@ -17,15 +17,40 @@ _BIT7 = const(1 << 7)
 
 
 class LCD:
-    def __init__(self, i2c, address=0x3F, check=True, bit_rs=0, bit_rw=1, bit_enable=2, bit_led=3, bit_data=4):
+    """
+    text() and print() draw into a framebuffer of cols * rows characters, flush() sends only the cells that changed.
+    Changed cells close together are sent as one run, after one pos() (the address counter moves on by itself).
+
+    write() encodes the E strobes for a whole run of characters into one buffer and sends it with one writeto.
+    There are no sleeps: the time a byte takes on the bus (9 bits at freq, the I2C clock) spaces them out.
+    A nibble is 2 bytes (data + E, data), padded so a character takes at least the 37 us the LCD needs to execute it.
+
+    Custom characters can be registered by name with glyph(), slot(name) gives the character code to print.
+    Which glyph is in each of the 8 CGRAM slots is tracked, so it's only uploaded when it isn't there yet.
+    With more than 8 glyphs the least recently used slot is replaced (and cells still showing it change with it).
+    """
+
+    def __init__(self, i2c, address=0x3F, check=True, bit_rs=0, bit_rw=1, bit_enable=2, bit_led=3, bit_data=4, cols=16, rows=2, freq=100000):
         self.i2c = i2c
         self.address = address
+        self.cols = cols
+        self.rows = rows
+        self.frame = bytearray(b' ' * (cols * rows))  # What should be on the display
+        self._shown = bytearray(self.frame)  # What is on the display
+        self._cursor = None  # Index in frame where the next character goes, None = unknown
         self.bit_rs = 1 << bit_rs
         self.bit_rw = 1 << bit_rw
         self.bit_enable = 1 << bit_enable
         self.bit_led = 1 << bit_led
         self.current_led = 1 << bit_led
         self.shift_data = bit_data
+        # Bytes per nibble: 2, or more if 4 bytes on the bus take less than 37 us.
+        self._stride = max(2, (37 * freq + 17999999) // 18000000)
+        self._buf = bytearray(1 + 2 * self._stride * cols)
+        self._mv = memoryview(self._buf)
+        self._glyphs = {}  # name: bitmap
+        self._slots = [None] * 8  # Name of the glyph in each CGRAM slot
+        self._used = list(range(8))  # CGRAM slots, least recently used first
         if check and address not in i2c.scan():
             raise Exception('LCD init failed: No device on address %x' % address)
 
@@ -39,17 +64,45 @@ class LCD:
     def clear(self):
         self.write_byte(0b1, rs=0)
         time.sleep(.01)
+        for i in range(len(self.frame)):
+            self.frame[i] = self._shown[i] = 0x20
+        self._cursor = 0
 
     def home(self):
         self.write_byte(0b10, rs=0)
         time.sleep(.01)
+        self._cursor = 0
 
     def pos(self, col, row=0):
-        self.write_byte(_BIT7 | (col & 0b111111) | ((row & 1) << 6), rs=0)
+        # Rows 2 & 3 (on 4 line displays) continue rows 0 & 1.
+        self.write_byte(_BIT7 | ((row & 1) << 6) + (row >> 1) * self.cols + col, rs=0)
+        self._cursor = row * self.cols + col
 
     def custom_char(self, char, data):
         self.write_byte(_BIT6 | ((7 & char) << 3), rs=0)
         self.write(data, rs=1)
+        self._cursor = None  # The address counter now points in CGRAM
+        self._slots[7 & char] = None
+
+    def glyph(self, name, bitmap):
+        """ Register a custom character (8 rows of 5 bits). It's uploaded the first time slot() needs it. """
+        bitmap = bytes(bitmap)
+        if self._glyphs.get(name) != bitmap:
+            self._glyphs[name] = bitmap
+            if name in self._slots:
+                self._slots[self._slots.index(name)] = None
+
+    def slot(self, name):
+        """ Character code (0 - 7) of glyph name. CGRAM is only written if the glyph isn't in a slot yet. """
+        if name in self._slots:
+            i = self._slots.index(name)
+        else:
+            i = self._used[0]
+            self.custom_char(i, self._glyphs[name])
+            self._slots[i] = name
+        self._used.remove(i)
+        self._used.append(i)
+        return i
 
     def display_control(self, enabled=True, cursor=True, blink=True):
         byte = 0b00001000
@@ -58,34 +111,75 @@ class LCD:
         if blink: byte |= _BIT0
         self.write_byte(byte, rs=0)
 
+    def _nibble(self, i, data, base):
+        """ Strobe for one nibble at _buf[i], returns where the next one goes. """
+        b = base | (data << self.shift_data)
+        buf = self._buf
+        buf[i] = b | self.bit_enable
+        for k in range(i + 1, i + self._stride):
+            buf[k] = b
+        return i + self._stride
+
     def write_nibble(self, data, rs):
-        self.i2c.writeto(self.address, bytes((
-            self.current_led | rs | (data << self.shift_data),
-            self.current_led | rs | self.bit_enable | (data << self.shift_data),
-            self.current_led | rs | (data << self.shift_data)
-        )))
-        time.sleep(.0001)
+        self._buf[0] = self.current_led | rs  # RS is set before E goes up
+        self.i2c.writeto(self.address, self._mv[:self._nibble(1, data, self._buf[0])])
 
     def write_byte(self, data, rs):
-        self.write(bytes((data, )), rs=rs)
+        base = self._buf[0] = self.current_led | rs
+        n = self._nibble(self._nibble(1, data >> 4, base), data & 0x0F, base)
+        self.i2c.writeto(self.address, self._mv[:n])
 
     def write(self, data, rs):
+        base = self._buf[0] = self.current_led | rs
+        n = 1
         for byte in data:
-            self.write_nibble((byte >> 4) & 0x0F, rs=rs)
-            self.write_nibble(byte & 0x0F, rs=rs)
+            if n == len(self._buf):
+                self.i2c.writeto(self.address, self._mv)
+                n = 1
+            n = self._nibble(self._nibble(n, byte >> 4, base), byte & 0x0F, base)
+        if n > 1:
+            self.i2c.writeto(self.address, self._mv[:n])
+
+    def text(self, text, col=0, row=0):
+        """ Put text in the framebuffer at col, row (cut off at the end of the line). Call flush() to show it. """
+        i = row * self.cols + col
+        n = min(len(text), self.cols - col)
+        self.frame[i:i + n] = text[:n]
+
+    def flush(self):
+        """ Send the cells that changed. Unchanged gaps of 1 cell are sent along, that's cheaper than a pos(). """
+        frame = self.frame
+        shown = self._shown
+        for row in range(self.rows):
+            i = row * self.cols
+            end = i + self.cols
+            while i < end:
+                if frame[i] == shown[i]:
+                    i += 1
+                    continue
+                j = i + 1
+                while j < end and (frame[j] != shown[j] or (j + 1 < end and frame[j + 1] != shown[j + 1])):
+                    j += 1
+                if self._cursor != i:
+                    self.pos(i - row * self.cols, row)
+                self.write(memoryview(frame)[i:j], self.bit_rs)
+                shown[i:j] = frame[i:j]
+                self._cursor = j if j < end else None  # The address counter doesn't go on to the next row
+                i = j
 
     def print(self, text):
-        self.clear()
-        lines = text.split(b'\n', 2)
-        self.write(lines[0], self.bit_rs)
-        if len(lines) == 2:
-            self.pos(0, 1)
-            self.write(lines[1], self.bit_rs)
+        """ Replaces everything on the display with text (lines split by \\n), only the changes are sent. """
+        for i in range(len(self.frame)):
+            self.frame[i] = 0x20
+        for row, line in enumerate(text.split(b'\n', self.rows - 1)):
+            self.text(line, 0, row)
+        self.flush()
 
     def init(self):
         time.sleep(.005)
-        self.write_byte(0b00110011, rs=0) # Force display in 8 bit mode
-        time.sleep(.005)
+        for _ in range(3):
+            self.write_nibble(0b0011, rs=0) # Force display in 8 bit mode
+            time.sleep(.005)
         self.write_nibble(0b0010, rs=0) # Set 4 bit mode
         time.sleep(.005)
         self.write_byte(0b00101000, rs=0) # Function set: 4 Bit, 2 Lines, Font 5*8
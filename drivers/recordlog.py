@@ -0,0 +1,141 @@
+# Record log on an AT24CXX EEPROM for MicroPython (on ESP8266)
+# Copyright (c) 2016 Dries007
+# License: MIT
+
+# To be used in combo with at24cxx.py
+#
+# Fixed size records, appended round robin over the whole region, so every page gets the same number of writes.
+# A record is: sequence number, timestamp, data, CRC16 (over the rest). Records never cross a page boundary.
+# A write that was cut off by a power loss fails its CRC and is ignored, it can only have hit the oldest record.
+# Record n always lives in slot n % slots, so the boot scan only has to find the newest valid record.
+#
+# Example:
+#   log = RecordLog(at24cxx.AT24CXX(i2c), 4)
+#   log.append(struct.pack('<f', rtc.temp()))
+#   for seq, timestamp, data in log.latest(10): ...
+
+import time
+import struct
+
+_HEADER = '<II'  # seq, timestamp
+_HEADER_SIZE = const(8)
+_CRC_SIZE = const(2)
+_EMPTY = const(0xFFFFFFFF)  # Erased EEPROM
+
+
+def crc16(data, crc=0xFFFF):
+    """ CRC-16/CCITT """
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+    return crc
+
+
+class RecordLog:
+    """
+    size bytes of data per record, in length bytes of the EEPROM from start (which should be page aligned).
+    The RAM index is only the newest record and the number of records, append is one page write.
+    """
+
+    def __init__(self, eeprom, size, start=0, length=4096):
+        self.eeprom = eeprom
+        self.size = size
+        self.start = start
+        self.record = _HEADER_SIZE + size + _CRC_SIZE
+        page = eeprom.page
+        if self.record <= page:
+            self.per_unit = page // self.record  # Records per page
+            self.unit = page
+        else:
+            self.per_unit = 1
+            self.unit = (self.record + page - 1) // page * page
+        self.slots = length // self.unit * self.per_unit
+        self._buf = bytearray(self.record)
+        self.seq = -1  # Newest record
+        self.count = 0
+        self._scan()
+
+    def __len__(self):
+        return self.count
+
+    def _address(self, slot):
+        return self.start + slot // self.per_unit * self.unit + slot % self.per_unit * self.record
+
+    def _check(self, slot):
+        """ seq of the record in _buf, if it's valid and belongs in slot, else -1. """
+        seq = struct.unpack_from(_HEADER, self._buf)[0]
+        if seq == _EMPTY or seq % self.slots != slot:
+            return -1
+        if crc16(memoryview(self._buf)[:-_CRC_SIZE]) != struct.unpack_from('<H', self._buf, self.record - _CRC_SIZE)[0]:
+            return -1
+        return seq
+
+    def _load(self, seq):
+        slot = seq % self.slots
+        self.eeprom.readinto(self._address(slot), self._buf)
+        return self._check(slot) == seq
+
+    def _scan(self):
+        """ One sequential read over the region, to find the newest record. """
+        gap = self.unit - self.per_unit * self.record
+        mv = memoryview(self._buf)
+        self.eeprom.write_address(self.start)
+        for slot in range(self.slots):
+            if slot and gap and not slot % self.per_unit:
+                self.eeprom.read_sequential_into(mv[:gap])
+            self.eeprom.read_sequential_into(self._buf)
+            seq = self._check(slot)
+            if seq > self.seq:
+                self.seq = seq
+        if self.seq < 0:
+            return
+        self.count = min(self.seq + 1, self.slots)
+        # Only the slot after the newest record can be torn (it held the oldest).
+        if self.count == self.slots and not self._load(self.seq + 1 - self.slots):
+            self.count -= 1
+
+    def append(self, data, timestamp=None):
+        """ Add a record (data is padded with zeros up to size). Returns its seq. """
+        if len(data) > self.size:
+            raise ValueError('Record data is %d bytes, max %d' % (len(data), self.size))
+        seq = self.seq + 1
+        buf = self._buf
+        struct.pack_into(_HEADER, buf, 0, seq, time.time() if timestamp is None else timestamp)
+        buf[_HEADER_SIZE:_HEADER_SIZE + len(data)] = data
+        for i in range(_HEADER_SIZE + len(data), _HEADER_SIZE + self.size):
+            buf[i] = 0
+        struct.pack_into('<H', buf, self.record - _CRC_SIZE, crc16(memoryview(buf)[:-_CRC_SIZE]))
+        self.eeprom.write(self._address(seq % self.slots), buf)
+        self.seq = seq
+        if self.count < self.slots:
+            self.count += 1
+        return seq
+
+    def read(self, seq):
+        """ (seq, timestamp, data) of record seq, None if it's not (or no longer) in the log. """
+        if not self.seq - self.count < seq <= self.seq or not self._load(seq):
+            return None
+        return seq, struct.unpack_from(_HEADER, self._buf)[1], bytes(self._buf[_HEADER_SIZE:_HEADER_SIZE + self.size])
+
+    def latest(self, n=1):
+        """ The newest n records, newest first. """
+        for seq in range(self.seq, max(self.seq - n, self.seq - self.count), -1):
+            record = self.read(seq)
+            if record is not None:
+                yield record
+
+    def since(self, timestamp):
+        """ Records with a timestamp >= timestamp, oldest first. Binary search, timestamps have to go up with seq. """
+        lo = self.seq - self.count + 1
+        hi = self.seq + 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._load(mid) and struct.unpack_from(_HEADER, self._buf)[1] >= timestamp:
+                hi = mid
+            else:
+                lo = mid + 1
+        for seq in range(lo, self.seq + 1):
+            record = self.read(seq)
+            if record is not None:
+                yield record
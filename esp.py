@@ -1,10 +1,17 @@
 import os
 import serial
 import time
-import binascii
-import textwrap
-import re
+import struct
+import socket
+import select
+import base64
+import hashlib
+import glob
+import functools
+import concurrent.futures
 
+import upload
+from bundle import Bundler
 from wifi import WIFI_SSID, WIFI_PASS
 
 
@@ -13,74 +20,538 @@ def ctrl(key):
     return chr(ord(key.upper()) - ord('A') + 1)
 
 
+RAW_PROMPT = b'raw REPL; CTRL-B to exit\r\n>'
+MANIFEST = '.manifest'
+
+
+def file_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def settings_files(data=None, app=None):
+    """ boot.py with the settings appended, and a main.py that starts app (if given). """
+    files = {}
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'boot.py'), 'rb') as f:
+        text = f.read().decode('ascii')
+
+    if data is None:
+        data = {}
+    data.setdefault('WIFI_SSID', WIFI_SSID)
+    data.setdefault('WIFI_PASS', WIFI_PASS)
+    for k, v in data.items():
+        text += '{} = {!r}\r\n'.format(k, v)
+    files['boot.py'] = text.encode('ascii')
+
+    if app is not None:
+        app = app.replace('.py', '')
+        text = 'from boot import *\r\n'
+        text += "if machine.reset_cause() == SLEEP_RESET or not wait_for(timeout=5, message='To abort booting \"{}\", press GPIO0'):\r\n".format(app)
+        text += '\timport {}\r\n'.format(app)
+        text += '\t{}.main()\r\n'.format(app)
+        files['main.py'] = text.encode('ascii')
+    return files
+
+
+@functools.lru_cache(maxsize=64)
+def transfer_blocks(filename, data, compress):
+    """ Compress once, no matter how many devices the file goes to. """
+    return tuple(upload.transfer(filename, data, compress))
+
+
+def expand_ports(patterns):
+    """ Comma separated ports and/or globs (eg /dev/ttyUSB*) to a sorted list of ports. """
+    ports = set()
+    for pattern in patterns:
+        for part in pattern.split(','):
+            if glob.has_magic(part):
+                ports.update(glob.glob(part))
+            elif part:
+                ports.add(part)
+    return sorted(ports)
+
+
+def connect(port, baudrate, password=None, **kwargs):
+    """ Esp for a serial port, WebRepl for ws://host[:port] """
+    if port.startswith('ws://'):
+        host, _, ws_port = port[5:].rstrip('/').partition(':')
+        return WebRepl(host, password, int(ws_port or 8266), **kwargs)
+    return Esp(port, baudrate, **kwargs)
+
+
+def fleet(ports, baudrate, files, verify=False, full=False, jobs=None, **kwargs):
+    """
+    Deploy the same files to all ports at once, one thread per device.
+    A failing device doesn't stop the others. Returns port -> (error or None, changed, removed, seconds).
+    """
+    for name, data in files.items():
+        transfer_blocks(name, data, kwargs.get('compress', True))
+
+    def one(port):
+        start = time.time()
+        esp = None
+        try:
+            esp = connect(port, baudrate, **kwargs)
+            changed, stale = esp.deploy(files, verify, full)
+            esp.reset()
+            return None, len(changed), len(stale), time.time() - start
+        except Exception as e:
+            print('{}: FAILED: {}'.format(port, e))
+            if esp is not None and esp.raw.is_open:
+                esp.close()
+            return e, 0, 0, time.time() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(ports)) as pool:
+        return dict(zip(ports, pool.map(one, ports)))
+
+
+def summary(results, elapsed):
+    """ Print a table of fleet results, returns how many devices failed. """
+    print()
+    print('{:20} {:8} {:>8} {:>8} {:>8}'.format('Port', 'Result', 'Uploaded', 'Removed', 'Time'))
+    for port, (error, changed, stale, seconds) in results.items():
+        print('{:20} {:8} {:8d} {:8d} {:7.2f}s'.format(port, 'FAILED' if error else 'OK', changed, stale, seconds))
+    failed = sum(1 for error, *_ in results.values() if error)
+    print('{} of {} devices OK in {:.2f}s'.format(len(results) - failed, len(results), elapsed))
+    return failed
+
+
+def collect(app, drivers, data=None, mpy_args=None, cache=None, bundle=False):
+    """
+    All files that make up a deploy of app with drivers: filename -> content
+    With bundle, the app and the drivers it imports become one tree-shaken module (see bundle.py).
+    With mpy_args (a list of extra mpy-cross arguments), the app and drivers are deployed as .mpy bytecode.
+    boot.py and main.py are always source, MicroPython only runs those as .py.
+    """
+    files = settings_files(data, app)
+    sources = {}
+    if bundle:
+        bundler = Bundler(['drivers'])
+        sources[app] = bundler.bundle('apps/' + app)[0]
+        drivers = [file for file in drivers if os.path.splitext(file)[0] not in bundler.modules]
+    for path in ([] if bundle else ['apps/' + app]) + ['drivers/' + file for file in drivers]:
+        with open(path, 'r', newline='') as in_f:
+            sources[os.path.basename(path)] = in_f.read()
+    for name, source in sources.items():
+        if mpy_args is not None:
+            files[upload.mpy_name(name)] = upload.compile_mpy(name, upload.optimize(source, {}), mpy_args, cache)
+        else:
+            files[name] = source.encode('utf8')
+    return files
+
+
 class Esp:
-    def __init__(self, port, baudrate):
+    """
+    Talks to the MicroPython REPL over serial.
+    Code is executed via the raw REPL (Ctrl-A). If the firmware supports it, raw-paste mode is used,
+    which lets the device tell us how much it can take (window) so we never have to sleep and hope.
+    """
+
+    def __init__(self, port, baudrate, timeout=10, raw_paste=True, compress=True):
         super().__init__()
-        # self.raw = serial.Serial(port, baudrate)
+        self.raw = serial.Serial(port, baudrate, timeout=timeout)
 
-        # if not self.raw.is_open:
-        #     raise RuntimeError("Port {} won't open.".format(port))
+        if not self.raw.is_open:
+            raise RuntimeError("Port {} won't open.".format(port))
+
+        self.port = port
+        self.timeout = timeout
+        self.raw_paste = raw_paste
+        self.compress = compress
+        self.in_raw = False
 
     def __del__(self):
-        self.reset()
+        if hasattr(self, 'raw') and self.raw.is_open:
+            self.reset()
 
     def kill(self):
-        self.send(ctrl('C'), 2)
+        self.send(ctrl('C') * 2)
+        time.sleep(0.1)
+        self.raw.reset_input_buffer()
 
     def reset(self):
-        # self.send(ctrl('D'), 5)
-        pass
+        self.exit_raw()
+        self.send(ctrl('D'))
+        self.raw.flush()
+        self.close()
+
+    def close(self):
+        self.raw.close()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        self.raw.write(data)
+
+    def read_until(self, ending, timeout=None):
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        data = b''
+        while not data.endswith(ending):
+            if time.time() > deadline:
+                raise RuntimeError('Timeout waiting for {!r} on {}, got {!r}'.format(ending, self.port, data[-100:]))
+            data += self.raw.read(1)
+        return data
+
+    def enter_raw(self):
+        if self.in_raw:
+            return
+        self.kill()
+        self.send(ctrl('A'))
+        self.read_until(RAW_PROMPT)
+        self.in_raw = True
+
+    def exit_raw(self):
+        if self.in_raw:
+            self.send(ctrl('B'))
+            self.in_raw = False
+
+    def _paste_write(self, data):
+        # Raw-paste: the device gives us a window size, and sends \x01 every time it has room for another window.
+        header = self.raw.read(2)
+        if len(header) != 2:
+            raise RuntimeError('Timeout reading raw-paste window size from {}'.format(self.port))
+        window = struct.unpack('<H', header)[0]
+        remain = window
+        i = 0
+        while i < len(data):
+            while remain == 0 or self.raw.in_waiting:
+                b = self.raw.read(1)
+                if b == b'\x01':
+                    remain += window
+                elif b == b'\x04':
+                    # Device aborted (eg. syntax error), acknowledge and let exec pick up the error.
+                    self.send(b'\x04')
+                    return
+                else:
+                    raise RuntimeError('Unexpected data during raw-paste on {}: {!r}'.format(self.port, b))
+            part = data[i:i + remain]
+            self.send(part)
+            remain -= len(part)
+            i += len(part)
+        self.send(b'\x04')
+        self.read_until(b'\x04')
+
+    def _raw_write(self, data):
+        # Old firmware without raw-paste: no flow control, so this is the only place we still sleep.
+        for i in range(0, len(data), 256):
+            self.send(data[i:i + 256])
+            time.sleep(0.01)
+        self.send(b'\x04')
+        if self.raw.read(2) != b'OK':
+            raise RuntimeError('Could not exec on {}'.format(self.port))
+
+    def exec_(self, code):
+        """ Execute code on the device, return its output. Raises RuntimeError if the device raised. """
+        if isinstance(code, str):
+            code = code.encode('utf8')
+        self.enter_raw()
 
-    def send(self, data, wait=0.100):
-        print(data.replace('\r\n', ''))
-        # self.raw.write(data.encode('ascii'))
-        # time.sleep(wait)
-        # out = self.raw.read_all()
-        # print(out.decode('ascii'), end="")
-        # return out
+        if self.raw_paste:
+            self.send(b'\x05A\x01')
+            answer = self.raw.read(2)
+            if answer == b'R\x01':
+                self._paste_write(code)
+            else:
+                if answer != b'R\x00':
+                    # Firmware doesn't know about raw-paste at all and prints the raw prompt again,
+                    # the first 2 bytes of which we already read as the answer.
+                    self.read_until(RAW_PROMPT[2:])
+                self.raw_paste = False
+                self._raw_write(code)
+        else:
+            self._raw_write(code)
+
+        out = self.read_until(b'\x04')[:-1]
+        err = self.read_until(b'\x04')[:-1]
+        self.read_until(b'>')
+        if err:
+            raise RuntimeError('Error on {}: {}'.format(self.port, err.decode('utf8', 'replace')))
+        return out
 
     def settings(self, data=None, app=None):
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'boot.py'), 'rb') as f:
-            text = f.read().decode('ascii')
-
-        if data is None:
-            data = {}
-        data.setdefault('WIFI_SSID', WIFI_SSID)
-        data.setdefault('WIFI_PASS', WIFI_PASS)
-        for k, v in data.items():
-            text += '{} = {!r}\r\n'.format(k, v)
-        self.save_file('boot.py', text.encode('ascii'))
-
-        if app is not None:
-            app = app.replace('.py', '')
-            text = 'from boot import *\r\n'
-            text += "if machine.reset_cause() == SLEEP_RESET or not wait_for(timeout=5, message='To abort booting \"{}\", press GPIO0'):\r\n".format(app)
-            text += '\timport {}\r\n'.format(app)
-            text += '\t{}.main()\r\n'.format(app)
-            self.save_file('main.py', text.encode('ascii'))
-
-    def save_file(self, filename, text):
-        # self.send(ctrl('E'))
-        self.send('import os\r\n')
-        # self.send('import ubinascii\r\n')
-        self.send('import gc\r\n')
-        self.send('gc.collect()\r\n')
-        # self.send('os.remove("{}")\r\n'.format(filename))
-        self.send('f = open("{}", "wb")\r\n'.format(filename))
-        # for part in re.findall('.{1,100}', text.decode('ascii'), re.DOTALL):
-        #     self.send('f.write(ubinascii.a2b_base64("{}"))\r\n'.format(binascii.b2a_base64(part.encode('ascii')).decode('ascii')[:-1]))
-        for part in re.findall('.{1,1000}', text.decode('ascii'), re.DOTALL):
-            self.send('f.write({!r})\r\n'.format(part))
-        # self.send('f.write({!r})\r\n'.format(text))
-        self.send('f.close()\r\n')
-        self.send('del f\r\n')
-        self.send('gc.collect()\r\n')
-        # self.send(ctrl('D'))
+        for name, text in settings_files(data, app).items():
+            self.save_file(name, text)
+
+    def save_file(self, filename, data):
+        start = time.time()
+        # One exec per block, so the device never has to compile more than one chunk of source.
+        for block in transfer_blocks(filename, data, self.compress):
+            self.exec_(block)
+        elapsed = time.time() - start
+        print('{}: {}: {} bytes in {:.2f}s ({:.0f} B/s)'.format(self.port, filename, len(data), elapsed, len(data) / elapsed if elapsed else 0))
+
+    def read_file(self, filename):
+        out = self.exec_('import ubinascii\n'
+                         'f = open({!r}, "rb")\n'
+                         'b = f.read(384)\n'
+                         'while b:\n'
+                         ' print(ubinascii.b2a_base64(b).decode(), end="")\n'
+                         ' b = f.read(384)\n'
+                         'f.close()\n'
+                         'del f, b\n'.format(filename))
+        return b''.join(base64.b64decode(line) for line in out.split())
 
     def delete(self, *params):
-        self.send('import os\r\n')
+        """ Remove files from the device, files that are already gone are skipped. """
         for param in params:
-            self.send('os.remove({!r})\r\n'.format(param))
+            self.exec_('import os\ntry:\n os.remove({!r})\nexcept OSError:\n pass\n'.format(param))
+
+    def manifest(self, verify=False):
+        """
+        Returns filename -> sha1 of what is on the device.
+        By default that's the manifest stored by the last deploy, with verify every file is hashed on the device instead.
+        """
+        if verify:
+            # In a function, so its names are gone afterwards whatever the loop got to bind (nothing, with no files).
+            out = self.exec_('import gc\nimport uos\nimport uhashlib\nimport ubinascii\ngc.collect()\n'
+                             'def h():\n'
+                             ' b = bytearray(256)\n'
+                             ' m = memoryview(b)\n'
+                             ' for n in uos.listdir():\n'
+                             '  d = uhashlib.sha1()\n'
+                             '  try:\n'
+                             '   f = open(n, "rb")\n'
+                             '  except OSError:\n'
+                             '   continue\n'
+                             '  k = f.readinto(b)\n'
+                             '  while k:\n'
+                             '   d.update(m[:k])\n'
+                             '   k = f.readinto(b)\n'
+                             '  f.close()\n'
+                             '  print(ubinascii.hexlify(d.digest()).decode(), n)\n'
+                             'h()\n'
+                             'del h\n'
+                             'gc.collect()\n')
+        else:
+            out = self.exec_('try:\n'
+                             ' f = open({!r})\n'
+                             ' print(f.read())\n'
+                             ' f.close()\n'
+                             ' del f\n'
+                             'except OSError:\n'
+                             ' pass\n'.format(MANIFEST))
+        result = {}
+        for line in out.decode('utf8').splitlines():
+            if line.strip():
+                h, name = line.strip().split(' ', 1)
+                result[name] = h
+        result.pop(MANIFEST, None)
+        return result
+
+    def deploy(self, files, verify=False, full=False):
+        """
+        Upload only the files (filename -> content) that differ from what's on the device,
+        and remove files a previous deploy put there that are no longer part of it.
+        With full, every file is uploaded regardless.
+        """
+        start = time.time()
+        old = self.manifest(verify)
+        new = {name: file_hash(data) for name, data in files.items()}
+        if verify:
+            # Only files we put there ourselves are candidates for removal, not data the app wrote.
+            tracked = self.manifest()
+            old = {name: h for name, h in old.items() if name in tracked or name in new}
+
+        changed = [name for name in files if full or old.get(name) != new[name]]
+        stale = [name for name in old if name not in new]
+
+        for name in changed:
+            self.save_file(name, files[name])
+        if stale:
+            self.delete(*stale)
+        if changed or stale or set(old) != set(new):
+            self.save_file(MANIFEST, ''.join('{} {}\n'.format(h, name) for name, h in new.items()).encode('utf8'))
+
+        print('{}: {} uploaded, {} removed, {} unchanged in {:.2f}s'.format(self.port, len(changed), len(stale), len(files) - len(changed), time.time() - start))
+        return changed, stale
+
+
+class WebSocket:
+    """
+    Just enough of a WebSocket client (RFC 6455) for WebREPL.
+    Text frames are the REPL terminal, and look like a serial port (read, write, in_waiting) so Esp can use it as is.
+    Binary frames are the file transfer protocol, see send_binary and read_binary.
+    """
+
+    def __init__(self, host, port, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timeout = timeout
+        self.is_open = True
+        self.text = bytearray()
+        self.binary = bytearray()
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall(b'GET / HTTP/1.1\r\nHost: %s\r\nConnection: Upgrade\r\nUpgrade: websocket\r\n'
+                          b'Sec-WebSocket-Version: 13\r\nSec-WebSocket-Key: %s\r\n\r\n' % (host.encode(), key))
+        header = b''
+        while not header.endswith(b'\r\n\r\n'):
+            data = self.sock.recv(1)
+            if not data:
+                raise RuntimeError('WebSocket handshake with {}:{} failed'.format(host, port))
+            header += data
+        if b' 101 ' not in header.split(b'\r\n', 1)[0]:
+            raise RuntimeError('WebSocket handshake with {}:{} failed: {!r}'.format(host, port, header))
+        # The server has to prove it speaks WebSocket, and answers this request: SHA-1 of the key and the RFC 6455 GUID.
+        accept = base64.b64encode(hashlib.sha1(key + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+        lines = header.split(b'\r\n')
+        if accept not in [line.split(b':', 1)[1].strip() for line in lines if line.lower().startswith(b'sec-websocket-accept:')]:
+            raise RuntimeError('WebSocket handshake with {}:{} failed: wrong Sec-WebSocket-Accept in {!r}'.format(host, port, header))
+
+    @staticmethod
+    def frame(data, binary):
+        # Client frames must be masked, a zero mask is allowed and saves XOR-ing every byte.
+        n = len(data)
+        if n < 126:
+            header = struct.pack('>BB', 0x82 if binary else 0x81, 0x80 | n)
+        elif n < 0x10000:
+            header = struct.pack('>BBH', 0x82 if binary else 0x81, 0x80 | 126, n)
+        else:
+            header = struct.pack('>BBQ', 0x82 if binary else 0x81, 0x80 | 127, n)
+        return header + b'\0\0\0\0' + data
+
+    def _recv_exact(self, n):
+        data = b''
+        while len(data) < n:
+            part = self.sock.recv(n - len(data))
+            if not part:
+                self.is_open = False
+                raise RuntimeError('WebSocket closed')
+            data += part
+        return data
+
+    def _recv_frame(self, timeout):
+        """ Read one frame into the text or binary buffer. Returns False on timeout. """
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return False
+        op, n = self._recv_exact(2)
+        mask = n & 0x80
+        n &= 0x7F
+        if n == 126:
+            n = struct.unpack('>H', self._recv_exact(2))[0]
+        elif n == 127:
+            n = struct.unpack('>Q', self._recv_exact(8))[0]
+        key = self._recv_exact(4) if mask else None
+        data = self._recv_exact(n)
+        if key:
+            data = bytes(b ^ key[i % 4] for i, b in enumerate(data))
+        op &= 0x0F
+        if op == 0x8:
+            self.is_open = False
+            raise RuntimeError('WebSocket closed by device')
+        elif op == 0x9:
+            self.sock.sendall(bytes((0x8A, 0x80 | len(data))) + b'\0\0\0\0' + data)  # pong
+        elif op == 0x2:
+            self.binary += data
+        else:
+            self.text += data
+        return True
+
+    def _read(self, buffer, size):
+        deadline = time.time() + self.timeout
+        while len(buffer) < size and self._recv_frame(max(0, deadline - time.time())):
+            pass
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    # Serial port look-alike, on the text frames.
+    def read(self, size=1):
+        return self._read(self.text, size)
+
+    def write(self, data):
+        self.sock.sendall(self.frame(data, False))
+
+    @property
+    def in_waiting(self):
+        while self._recv_frame(0):
+            pass
+        return len(self.text)
+
+    def reset_input_buffer(self):
+        while self._recv_frame(0):
+            pass
+        self.text.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.is_open:
+            try:
+                self.sock.sendall(b'\x88\x80\0\0\0\0')
+            except OSError:
+                pass
+        self.is_open = False
+        self.sock.close()
+
+    # File transfer, on the binary frames.
+    def send_binary(self, *parts):
+        """ All parts go out as separate frames in one send, nothing waits for the device in between. """
+        self.sock.sendall(b''.join(self.frame(part, True) for part in parts))
+
+    def read_binary(self, size):
+        data = self._read(self.binary, size)
+        if len(data) != size:
+            raise RuntimeError('Timeout waiting for WebREPL file transfer response')
+        return data
+
+
+class WebRepl(Esp):
+    """
+    Same as Esp, but over WiFi with WebREPL (import webrepl; webrepl.start() on the device).
+    Code runs through the raw REPL on the WebSocket text frames, files are moved with the binary WebREPL file protocol.
+    File data is pipelined: after the device accepts a file, all of it is send without waiting.
+    """
+
+    REQUEST = '<2sBBQLH64s'
+    PUT = 1
+    GET = 2
+
+    def __init__(self, host, password, port=8266, timeout=10, raw_paste=True, compress=True, chunk_size=1024):
+        if password is None:
+            raise ValueError('WebREPL on {}:{} needs a password (-p/--password)'.format(host, port))
+        self.raw = WebSocket(host, port, timeout)
+        self.port = 'ws://{}:{}'.format(host, port)
+        self.timeout = timeout
+        self.raw_paste = raw_paste
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.in_raw = False
+
+        self.read_until(b'Password: ')
+        self.send(password.encode('utf8') + b'\r')
+        self.read_until(b'>>> ')
+
+    def _request(self, op, filename, size=0):
+        name = filename.encode('utf8')
+        if len(name) > 64:
+            raise RuntimeError('WebREPL filenames can be at most 64 bytes: {}'.format(filename))
+        self.raw.send_binary(struct.pack(self.REQUEST, b'WA', op, 0, 0, size, len(name), name))
+        self._response(filename)
+
+    def _response(self, filename):
+        sig, code = struct.unpack('<2sH', self.raw.read_binary(4))
+        if sig != b'WB' or code != 0:
+            raise RuntimeError('WebREPL transfer of {} on {} failed ({!r} {})'.format(filename, self.port, sig, code))
+
+    def save_file(self, filename, data):
+        start = time.time()
+        self._request(self.PUT, filename, len(data))
+        self.raw.send_binary(*(data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size)))
+        self._response(filename)
+        elapsed = time.time() - start
+        print('{}: {}: {} bytes in {:.2f}s ({:.0f} B/s)'.format(self.port, filename, len(data), elapsed, len(data) / elapsed if elapsed else 0))
+
+    def read_file(self, filename):
+        self._request(self.GET, filename)
+        data = b''
+        while True:
+            self.raw.send_binary(b'\0')
+            size = struct.unpack('<H', self.raw.read_binary(2))[0]
+            if size == 0:
+                break
+            data += self.raw.read_binary(size)
+        self._response(filename)
+        return data
 
 
 def main():
@@ -88,23 +559,38 @@ def main():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('port', help='Serial port')
+    parser.add_argument('port', help='Serial port or ws://host[:port] for WebREPL, or several: comma separated and/or a glob like "/dev/ttyUSB*"')
     parser.add_argument('-b', '--baudrate', help='Serial baudrate', type=int, default=115200)
+    parser.add_argument('-p', '--password', help='WebREPL password')
+    parser.add_argument('-t', '--timeout', help='Seconds to wait for the device to respond', type=float, default=10)
+    parser.add_argument('--no-raw-paste', help='Never use raw-paste mode (for very old firmware)', action='store_true')
+    parser.add_argument('--no-compress', help='Send files as plain f.write lines instead of deflate + base64', action='store_true')
+    parser.add_argument('--full', help='Upload every file, even if the device manifest says it is unchanged', action='store_true')
+    parser.add_argument('--verify', help='Hash the files on the device instead of trusting its manifest', action='store_true')
+    parser.add_argument('--bundle', help='Deploy the app and the drivers it imports as one module, without the unused parts', action='store_true')
+    parser.add_argument('--mpy', help='Deploy the app and drivers as .mpy bytecode (needs mpy-cross)', action='store_true')
+    parser.add_argument('--mpy-args', help='Extra arguments for mpy-cross', nargs='*', default=[])
+    parser.add_argument('-j', '--jobs', help='Max devices to deploy to at once (default: all)', type=int)
     parser.add_argument('app', help='Input file')
     parser.add_argument('drivers', help='Extra driver files', nargs='*')
 
     args = parser.parse_args()
 
-    esp = Esp(args.port, args.baudrate)
+    ports = expand_ports([args.port])
+    if not ports:
+        parser.error('No ports match {}'.format(args.port))
 
-    esp.settings(app=args.app)
+    files = collect(args.app, args.drivers, mpy_args=args.mpy_args if args.mpy else None, cache=upload.Cache() if args.mpy else None, bundle=args.bundle)
+    if args.mpy:
+        for name, data in files.items():
+            print('{}: {} bytes'.format(name, len(data)))
 
-    with open('apps/' + args.app, 'rb') as in_f:
-        esp.save_file(args.app, in_f.read())
+    start = time.time()
+    results = fleet(ports, args.baudrate, files, args.verify, args.full, args.jobs,
+                    password=args.password, timeout=args.timeout, raw_paste=not args.no_raw_paste, compress=not args.no_compress)
 
-    for file in args.drivers:
-        with open('drivers/' + file, 'rb') as in_f:
-            esp.save_file(file, in_f.read())
+    if summary(results, time.time() - start):
+        raise SystemExit(1)
 
 if __name__ == '__main__':
     main()
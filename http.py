@@ -7,49 +7,348 @@
 from boot import *
 
 
-def http_get(host, url, headers=None, port=80):
-    import socket
-    headers_ = {'Host': host, 'User-Agent': PYTHON_VERSION, 'Connection': 'close', 'UUID': UUID}
+class Response:
+    """
+    Parses the status line and headers as they come in, then leaves the body on the socket.
+    Read the body with readinto (into your own buffer), iter_content (a generator over your own buffer) or read (all of it).
+    Content-Length and chunked transfer encoding are honoured, otherwise the body ends when the server closes.
+    """
+
+    def __init__(self, s, keep_head=False, f=None, release=None):
+        self.s = s
+        self.f = f or s.makefile('rb')
+        self.release = release
+        line = self.f.readline()
+        head = [line] if keep_head else None
+        version, status = line.split(None, 2)[:2]
+        self.status = int(status)
+        self.headers = {}
+        while True:
+            line = self.f.readline()
+            if line in (b'\r\n', b''):
+                break
+            if keep_head:
+                head.append(line)
+            k, v = line.split(b':', 1)
+            self.headers[str(k.strip(), 'utf8').lower()] = str(v.strip(), 'utf8')
+        self.head = str(b''.join(head), 'utf8').rstrip() if keep_head else None
+        self.chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+        # Bytes left in the body (or in the current chunk). None = until the socket closes.
+        self.remaining = 0 if self.chunked else (int(self.headers['content-length']) if 'content-length' in self.headers else None)
+        if self.status in (204, 304):
+            self.remaining = 0
+            self.chunked = False
+        self.done = self.remaining == 0 and not self.chunked
+        # Can the connection be used for another request once the body is read?
+        connection = self.headers.get('connection', '').lower()
+        self.reusable = (self.chunked or self.remaining is not None) and connection != 'close' and (version == b'HTTP/1.1' or connection == 'keep-alive')
+
+    def _next_chunk(self):
+        size = int(self.f.readline().split(b';', 1)[0], 16)
+        if size == 0:
+            while self.f.readline() not in (b'\r\n', b''):  # trailers
+                pass
+            self.done = True
+        self.remaining = size
+
+    def readinto(self, buf):
+        """ Read up to len(buf) bytes of body into buf, return how many. 0 means the body is done. """
+        if self.done:
+            return 0
+        if self.chunked and self.remaining == 0:
+            self._next_chunk()
+            if self.done:
+                return 0
+        mv = memoryview(buf)
+        if self.remaining is not None:
+            if self.remaining == 0:
+                self.done = True
+                return 0
+            if self.remaining < len(mv):
+                mv = mv[:self.remaining]
+        n = self.f.readinto(mv)
+        if not n:
+            self.done = True
+            return 0
+        if self.remaining is not None:
+            self.remaining -= n
+            if self.remaining == 0:
+                if self.chunked:
+                    self.f.readline()  # CRLF after the chunk data
+                else:
+                    self.done = True
+        return n
+
+    def iter_content(self, buf):
+        """ Yields memoryviews on buf, each valid until the next one. """
+        mv = memoryview(buf)
+        while True:
+            n = self.readinto(buf)
+            if not n:
+                return
+            yield mv[:n]
+
+    def read(self, size=256):
+        """ The whole (rest of the) body as bytes. Only for responses that fit in RAM. """
+        buf = bytearray(size)
+        out = bytearray()
+        for part in self.iter_content(buf):
+            out += part
+        return bytes(out)
+
+    def close(self):
+        """ Hands the connection back to its Session if the whole body was read, closes it otherwise. """
+        if self.release is not None and self.done and self.reusable:
+            self.release(self.s, self.f)
+        else:
+            self.s.close()
+        self.release = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Request line and headers are put together in here, so they go out in one write (one TCP segment if it fits).
+_buf = bytearray(512)
+_mv = memoryview(_buf)
+
+# The fixed header values, encoded once instead of on every request.
+_AGENT = PYTHON_VERSION.encode()
+_UUID = UUID.encode()
+
+
+def _length(data):
+    if hasattr(data, 'readinto'):
+        pos = data.seek(0, 1)
+        end = data.seek(0, 2)
+        data.seek(pos)
+        return end - pos
+    return len(data)
+
+
+def _headers(host, data, headers, connection='close'):
+    headers_ = {'Host': host, 'User-Agent': _AGENT, 'Connection': connection, 'UUID': _UUID}
+    if data is not None:
+        headers_['Content-Length'] = _length(data)
     if headers:
         for k, v in headers.items():
             headers_[k] = v
-    addr = socket.getaddrinfo(host, port)[0][-1]
-    s = socket.socket()
-    s.connect(addr)
-    s.send(bytes('GET /%s HTTP/1.1\r\n' % url, 'utf8'))
-    for k, v in headers_.items():
-        s.send(bytes('%s: %s\r\n' % (k, v), 'utf8'))
-    s.send(bytes('\r\n', 'utf8'))
-    resp = ''
+    return headers_
+
+
+# Encoded header names, values, urls, ... so a request like the last one doesn't allocate. At most _ENCODED of them.
+_encoded = {}
+_ENCODED = 48
+
+
+def _put(mv, i, data):
+    """ Writes data into mv at i, returns where it ends. Bytes go as they are, anything else as str(data). """
+    if type(data) is int and data >= 0:
+        n = i + 1
+        k = data
+        while k > 9:
+            k //= 10
+            n += 1
+        k = n
+        while k > i:
+            k -= 1
+            mv[k] = 48 + data % 10
+            data //= 10
+        return n
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        if not isinstance(data, str):
+            data = str(data)
+        encoded = _encoded.get(data)
+        if encoded is None:
+            encoded = data.encode()
+            if len(_encoded) < _ENCODED:
+                _encoded[data] = encoded
+        data = encoded
+    n = i + len(data)
+    mv[i:n] = data
+    return n
+
+
+def _serialize(mv, method, url, headers_):
+    n = _put(mv, 0, method)
+    n = _put(mv, n, b' ')
+    n = _put(mv, n, url)
+    n = _put(mv, n, b' HTTP/1.1\r\n')
+    for k in headers_:  # Not items(), MicroPython makes a tuple for each of those
+        n = _put(mv, n, k)
+        n = _put(mv, n, b': ')
+        n = _put(mv, n, headers_[k])
+        n = _put(mv, n, b'\r\n')
+    return _put(mv, n, b'\r\n')
+
+
+def _prepare(method, url, headers_):
+    """ Request line and headers in the shared buffer, returns (memoryview on it, length). """
+    global _buf, _mv
     while True:
-        data = s.recv(100)
-        if data:
-            resp += str(data, 'utf8')
-        else:
-            break
-    return resp.split("\r\n\r\n", 1)
+        try:
+            return _mv, _serialize(_mv, method, url, headers_)
+        except (ValueError, IndexError):
+            # Doesn't fit, only happens with lots of (or big) headers.
+            _buf = bytearray(len(_buf) * 2)
+            _mv = memoryview(_buf)
 
 
-def http_post(host, url='/', data='', headers=None, port=80):
+def _send(s, method, url, headers_, data):
+    """
+    Request line, headers and the body (if it fits) are written into one reused buffer and sent with one sendall.
+    Bigger bodies are sent right after it, a file (anything with readinto) is streamed through the same buffer.
+    """
+    mv, n = _prepare(method, url, headers_)
+    if data is None:
+        pass
+    elif hasattr(data, 'readinto'):
+        while True:
+            k = data.readinto(mv[n:])
+            if not k:
+                break
+            n += k
+            if n == len(mv):
+                s.sendall(mv)
+                n = 0
+    elif n + len(data) <= len(mv):
+        n = _put(mv, n, data)
+    else:
+        s.sendall(mv[:n])
+        n = 0
+        s.sendall(data)
+    if n:
+        s.sendall(mv[:n])
+
+
+def _body(method, data):
+    if isinstance(data, str):
+        data = bytes(data, 'utf8')
+    return None if method == 'GET' and not data else data
+
+
+def request(method, host, url='/', data='', headers=None, port=80, keep_head=False):
+    """ Send a request, return a Response with the body still to be read. Close it when done. """
     import socket
-    headers_ = {'Host': host, 'User-Agent': PYTHON_VERSION, 'Connection': 'close', 'UUID': UUID, 'Content-Length': len(data)}
-    if headers:
-        for k, v in headers.items():
-            headers_[k] = v
+    data = _body(method, data)
     addr = socket.getaddrinfo(host, port)[0][-1]
     s = socket.socket()
     s.connect(addr)
-    s.send(bytes('POST %s HTTP/1.1\r\n' % url, 'utf8'))
-    for k, v in headers_.items():
-        s.send(bytes('%s: %s\r\n' % (k, v), 'utf8'))
-    s.send(bytes('\r\n', 'utf8'))
-    s.send(bytes(data, 'utf8'))
-    s.send(bytes('\r\n', 'utf8'))
-    resp = ''
-    while True:
-        data = s.recv(100)
-        if data:
-            resp += str(data, 'utf8')
-        else:
-            break
-    return resp.split("\r\n\r\n", 1)
+    _send(s, method, url, _headers(host, data, headers), data)
+    return Response(s, keep_head)
+
+
+def _split(r):
+    # Old return value: [head, body]
+    with r:
+        return [r.head, str(r.read(), 'utf8')]
+
+
+def http_get(host, url, headers=None, port=80):
+    return _split(request('GET', host, '/%s' % url, headers=headers, port=port, keep_head=True))
+
+
+def http_post(host, url='/', data='', headers=None, port=80):
+    return _split(request('POST', host, url, data, headers, port, keep_head=True))
+
+
+class Session:
+    """
+    Keeps connections open (Connection: keep-alive) and remembers DNS lookups, for things that post every few seconds.
+    At most max_idle idle connections are kept per host. A connection the server closed in the mean time is replaced.
+    http_get and http_post work like the functions with the same name, stats() tells you what it saved.
+    """
+
+    def __init__(self, max_idle=2, dns_ttl=300):
+        self.max_idle = max_idle
+        self.dns_ttl = dns_ttl
+        self.dns = {}
+        self.idle = {}
+        self.lookups = 0
+        self.lookups_saved = 0
+        self.handshakes = 0
+        self.handshakes_saved = 0
+
+    def _addr(self, host, port):
+        import time
+        key = (host, port)
+        cached = self.dns.get(key)
+        if cached is not None and time.time() < cached[1]:
+            self.lookups_saved += 1
+            return cached[0]
+        import socket
+        addr = socket.getaddrinfo(host, port)[0][-1]
+        self.lookups += 1
+        self.dns[key] = (addr, time.time() + self.dns_ttl)
+        return addr
+
+    def _connect(self, host, port):
+        import socket
+        s = socket.socket()
+        try:
+            s.connect(self._addr(host, port))
+        except OSError:
+            # Maybe the address changed, look it up again next time.
+            self.dns.pop((host, port), None)
+            s.close()
+            raise
+        self.handshakes += 1
+        return s, s.makefile('rb')
+
+    def _release(self, key):
+        def release(s, f):
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((s, f))
+            else:
+                s.close()
+        return release
+
+    def request(self, method, host, url='/', data='', headers=None, port=80, keep_head=False):
+        """ Like request(), but over a pooled connection. Close (or fully read) the Response to give it back. """
+        key = (host, port)
+        data = _body(method, data)
+        headers_ = _headers(host, data, headers, 'keep-alive')
+        # A file body is read to the end by every attempt, a retry starts again where the first one did.
+        pos = data.seek(0, 1) if hasattr(data, 'readinto') else None
+        idle = self.idle.get(key)
+        while idle:
+            s, f = idle.pop()
+            try:
+                if pos is not None:
+                    data.seek(pos)
+                _send(s, method, url, headers_, data)
+                r = Response(s, keep_head, f, self._release(key))
+            except (OSError, ValueError, IndexError):
+                # Stale: the server closed it while it was idle.
+                s.close()
+                continue
+            self.handshakes_saved += 1
+            return r
+        s, f = self._connect(host, port)
+        try:
+            if pos is not None:
+                data.seek(pos)
+            _send(s, method, url, headers_, data)
+            return Response(s, keep_head, f, self._release(key))
+        except Exception:
+            s.close()
+            raise
+
+    def http_get(self, host, url, headers=None, port=80):
+        return _split(self.request('GET', host, '/%s' % url, headers=headers, port=port, keep_head=True))
+
+    def http_post(self, host, url='/', data='', headers=None, port=80):
+        return _split(self.request('POST', host, url, data, headers, port, keep_head=True))
+
+    def stats(self):
+        return {'lookups': self.lookups, 'lookups_saved': self.lookups_saved, 'handshakes': self.handshakes, 'handshakes_saved': self.handshakes_saved}
+
+    def close(self):
+        for idle in self.idle.values():
+            for s, f in idle:
+                s.close()
+        self.idle = {}
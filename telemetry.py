@@ -0,0 +1,188 @@
+# Telemetry queue for MicroPython (on ESP8266)
+# Copyright (c) 2016 Dries007
+# License: MIT
+
+# To be used in combo with boot.py and http.py
+#
+# Readings are packed with struct into a ring buffer on flash (a file) or on an AT24CXX EEPROM,
+# so they are not lost while the WiFi is down (or over a reset). flush() sends them in batches, one POST per batch.
+# The body of a POST is the packed records back to back, the struct format is in the X-Record-Format header.
+#
+# Like recordlog.py, every record carries a sequence number and record n always lives in slot n % capacity, so an
+# append is one write to its own slot and the boot scan finds the newest record. Nothing is rewritten per append.
+# What has been sent is a flush mark (the seq of the oldest unsent record), written once per flush round robin over
+# _MARKS places. The header (magic & record size) is only written when the storage is formatted.
+#
+# Example:
+#   q = Telemetry(FileStorage('telemetry.bin', 4096), '<If', 'example.com', '/api/readings')
+#   q.append(time.time(), rtc.temp())
+#   q.flush()
+
+import time
+import struct
+
+import http
+from boot import wlan
+
+_MAGIC = const(0x5452)
+_HEADER = '<HH'  # magic, record size
+_SEQ = '<I'  # In front of every record, and a flush mark
+_MARKS = const(8)
+_DATA = const(36)  # Header and flush marks, the record slots start here
+
+
+class FileStorage:
+    """ Fixed size file on the internal flash. """
+
+    def __init__(self, path, size=4096):
+        self.size = size
+        try:
+            self.f = open(path, 'r+b')
+        except OSError:
+            self.f = open(path, 'w+b')
+            zeros = bytes(64)
+            for _ in range(0, size, 64):
+                self.f.write(zeros)
+            self.f.flush()
+
+    def read(self, offset, size):
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def write(self, offset, data):
+        self.f.seek(offset)
+        self.f.write(data)
+        self.f.flush()
+
+
+class EepromStorage:
+    """ size bytes starting at start on an AT24CXX. """
+
+    def __init__(self, eeprom, start=0, size=4096):
+        self.eeprom = eeprom
+        self.start = start
+        self.size = size
+
+    def read(self, offset, size):
+        return self.eeprom.read(self.start + offset, size)
+
+    def write(self, offset, data):
+        # The driver splits on its page size and polls for the end of the write cycle.
+        self.eeprom.write(self.start + offset, data)
+
+
+class Telemetry:
+    """
+    Bounded queue of struct packed records. When it's full, the oldest record is overwritten (and counted in dropped).
+    A failed flush waits backoff seconds before the next try, doubling every failure up to max_backoff.
+    """
+
+    def __init__(self, storage, fmt, host, url='/', port=80, batch=32, backoff=5, max_backoff=600, headers=None, session=None):
+        self.storage = storage
+        self.fmt = fmt
+        self.host = host
+        self.url = url
+        self.port = port
+        self.batch = batch
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.headers = {'Content-Type': 'application/octet-stream', 'X-Record-Format': fmt}
+        if headers:
+            for k, v in headers.items():
+                self.headers[k] = v
+        # An http.Session keeps the connection open between batches.
+        self.http = session or http
+        self.size = struct.calcsize(fmt)
+        self.slot = 4 + self.size  # seq, record
+        self.capacity = (storage.size - _DATA) // self.slot
+        self.record = bytearray(self.slot)
+        self.mark = bytearray(4)
+        self.failures = 0
+        self.next_try = 0
+        self.dropped = 0
+        magic, size = struct.unpack(_HEADER, storage.read(0, 4))
+        if magic != _MAGIC or size != self.size:
+            self._format()
+        self._scan()
+
+    def __len__(self):
+        return self.count
+
+    def _format(self):
+        """ Zeros everywhere (no records, no marks), then the header. """
+        zeros = bytes(64)
+        for offset in range(0, self.storage.size, 64):
+            self.storage.write(offset, zeros[:self.storage.size - offset])
+        self.storage.write(0, struct.pack(_HEADER, _MAGIC, self.size))
+
+    def _scan(self):
+        """ The newest record from the sequence numbers in the slots, the oldest unsent one from the newest flush mark. """
+        self.seq = 0  # Newest record, the first one is 1
+        for slot in range(self.capacity):
+            seq = struct.unpack(_SEQ, self.storage.read(_DATA + slot * self.slot, 4))[0]
+            if seq % self.capacity == slot and seq > self.seq:  # Formatting left 0 everywhere
+                self.seq = seq
+        marks = struct.unpack('<%dI' % _MARKS, self.storage.read(4, 4 * _MARKS))
+        self._mark = marks.index(max(marks))
+        self.head = min(max(marks[self._mark], self.seq - self.capacity + 1, 1), self.seq + 1)  # Oldest unsent record
+        self.count = self.seq + 1 - self.head
+
+    def _save(self):
+        self._mark = (self._mark + 1) % _MARKS
+        struct.pack_into(_SEQ, self.mark, 0, self.head)
+        self.storage.write(4 + 4 * self._mark, self.mark)
+
+    def append(self, *values):
+        seq = self.seq + 1
+        struct.pack_into(_SEQ, self.record, 0, seq)
+        struct.pack_into(self.fmt, self.record, 4, *values)
+        self.storage.write(_DATA + seq % self.capacity * self.slot, self.record)
+        self.seq = seq
+        if self.count == self.capacity:
+            self.head += 1
+            self.dropped += 1
+        else:
+            self.count += 1
+
+    def peek(self, n):
+        """ The oldest n records, packed. """
+        slot = self.head % self.capacity
+        first = min(n, self.capacity - slot)
+        data = self.storage.read(_DATA + slot * self.slot, first * self.slot)
+        if n > first:
+            data += self.storage.read(_DATA, (n - first) * self.slot)
+        mv = memoryview(data)
+        out = bytearray(n * self.size)
+        for i in range(n):  # Without the sequence numbers
+            out[i * self.size:(i + 1) * self.size] = mv[i * self.slot + 4:(i + 1) * self.slot]
+        return out
+
+    def records(self, n):
+        """ The oldest n records, unpacked. """
+        data = self.peek(n)
+        return [struct.unpack_from(self.fmt, data, i * self.size) for i in range(n)]
+
+    def flush(self, force=False):
+        """ Send as many batches as possible. Returns the number of records sent. force ignores the backoff. """
+        sent = 0
+        while self.count:
+            if (not force and time.time() < self.next_try) or not wlan.isconnected():
+                break
+            n = min(self.count, self.batch)
+            try:
+                with self.http.request('POST', self.host, self.url, self.peek(n), self.headers, self.port) as r:
+                    r.read()
+                    ok = 200 <= r.status < 300
+            except (OSError, ValueError, IndexError):
+                ok = False
+            if not ok:
+                self.failures += 1
+                self.next_try = time.time() + min(self.max_backoff, self.backoff << min(self.failures - 1, 16))
+                break
+            self.failures = 0
+            self.head += n
+            self.count -= n
+            sent += n
+        if sent:
+            self._save()
+        return sent
@@ -0,0 +1,126 @@
+# Host-side tests for ahttp.py, against a local asyncio server
+# Run with: python -m pytest test/ahttp_test.py
+
+import time
+import asyncio
+
+import pytest
+
+from conftest import load
+
+# ahttp does import http, that has to be http.py and not the package of the standard library.
+ahttp = load('ahttp.py', http=load('http.py', 'mpy_http'))
+
+
+class Server:
+    """
+    GET /sleep/<seconds>: answers after that long. GET /chunked/<size>/<chunk>: size bytes in chunks of chunk bytes.
+    POST: echoes the body. Requests are kept as (head, body), running counts the ones being answered right now.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.running = 0
+        self.most = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.running += 1
+        self.most = max(self.most, self.running)
+        try:
+            head = [await reader.readline()]
+            while head[-1] not in (b'\r\n', b''):
+                head.append(await reader.readline())
+            length = [int(line.split(b':')[1]) for line in head if line.lower().startswith(b'content-length')]
+            body = await reader.readexactly(length[0]) if length else b''
+            self.requests.append((b''.join(head), body))
+            path = head[0].split()[1].decode().split('/')[1:]
+            if path[0] == 'sleep':
+                await asyncio.sleep(float(path[1]))
+                body = b'slept'
+            if path[0] == 'chunked':
+                size, chunk = int(path[1]), int(path[2])
+                data = bytes(48 + i % 64 for i in range(size))
+                writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+                for i in range(0, size, chunk):
+                    writer.write(b'%x;ext=1\r\n%s\r\n' % (len(data[i:i + chunk]), data[i:i + chunk]))
+                    await writer.drain()
+                writer.write(b'0\r\nX-Trailer: yes\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+            await writer.drain()
+        finally:
+            self.running -= 1
+            writer.close()
+
+
+def run(test):
+    """ Runs the coroutine function test(server) against a fresh server """
+    async def main():
+        server = Server()
+        await server.start()
+        try:
+            return await test(server)
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_post():
+    async def test(server):
+        head, body = await ahttp.http_post('127.0.0.1', '/echo', 'h\xe9llo', {'X-Test': 'yes'}, port=server.port)
+        assert head.startswith('HTTP/1.1 200 OK') and body == 'h\xe9llo'
+        sent = server.requests[0][0]
+        assert sent.startswith(b'POST /echo HTTP/1.1\r\n')
+        for line in (b'User-Agent: micropython/1.8.6', b'UUID: 0123456789ab', b'Content-Length: 6', b'X-Test: yes'):
+            assert line + b'\r\n' in sent
+    run(test)
+
+
+@pytest.mark.parametrize('size, chunk', [(10, 1), (1000, 100), (5000, 4096), (0, 1)])
+def test_chunked(size, chunk):
+    async def test(server):
+        head, body = await ahttp.http_get('127.0.0.1', 'chunked/%d/%d' % (size, chunk), port=server.port)
+        assert body == bytes(48 + i % 64 for i in range(size)).decode()
+
+        r = await ahttp.request('GET', '127.0.0.1', '/chunked/%d/%d' % (size, chunk), port=server.port)
+        parts = []
+        while True:
+            part = await r.read_chunk(7)
+            if not part:
+                break
+            assert len(part) <= 7
+            parts.append(part)
+        await r.close()
+        assert b''.join(parts) == body.encode()
+    run(test)
+
+
+def test_gather():
+    async def test(server):
+        start = time.monotonic()
+        results = await asyncio.gather(*(ahttp.http_get('127.0.0.1', 'sleep/0.3', port=server.port) for _ in range(4)))
+        assert [body for head, body in results] == ['slept'] * 4
+        # All four at once, not one after the other.
+        assert server.most == 4
+        assert time.monotonic() - start < 1.0
+    run(test)
+
+
+def test_timeout():
+    async def test(server):
+        with pytest.raises(asyncio.TimeoutError):
+            await ahttp.http_get('127.0.0.1', 'sleep/2', port=server.port, timeout=0.2)
+        # A request that times out doesn't hold up the others.
+        fast, slow = await asyncio.gather(ahttp.http_get('127.0.0.1', 'sleep/0', port=server.port),
+                                          ahttp.http_get('127.0.0.1', 'sleep/2', port=server.port, timeout=0.2), return_exceptions=True)
+        assert fast[1] == 'slept'
+        assert isinstance(slow, asyncio.TimeoutError)
+    run(test)
@@ -21,17 +21,34 @@ eeprom = at24cxx.AT24CXX(i2c)
 rnd = bytearray(uos.urandom(10))
 
 eeprom.write(0, rnd)
-time.sleep(.1)
 print(eeprom.read(0, 10) == rnd)
 
 eeprom.write_address(1)
-time.sleep(.1)
 print(eeprom.read_sequential(4) == rnd[1:5])
 
 rnd_ = uos.urandom(1)[0]
 eeprom.write_byte(0, rnd_)
-time.sleep(.1)
 
 rnd[0] = rnd_
 print(eeprom.read(0, 10) == rnd)
-time.sleep(.1)
+
+# Across page boundaries, from a memoryview
+rnd = bytearray(uos.urandom(100))
+eeprom.write(20, memoryview(rnd)[10:])
+print(eeprom.read(20, 90) == rnd[10:])
+
+# Whole chip (AT24C32)
+rnd = uos.urandom(4096)
+start = time.ticks_ms()
+eeprom.write(0, rnd)
+eeprom.wait()
+print("4 KB write:", time.ticks_diff(time.ticks_ms(), start), "ms")
+print(eeprom.read(0, 4096) == rnd)
+
+# Block device
+block = bytearray(eeprom.block_size)
+eeprom.writeblocks(1, b'block', 10)
+eeprom.readblocks(1, block)
+print(block[10:15] == b'block', eeprom.ioctl(4, 0), eeprom.ioctl(5, 0))
+eeprom.ioctl(3, 0)
+print(eeprom.read(eeprom.block_size + 10, 5) == b'block')
@@ -0,0 +1,69 @@
+# Host-side tests for drivers/clock.py, on a fake DS3231 and the ESP8266 ticks_ms
+# Run with: python -m pytest test/clock_test.py
+
+import types
+
+import pytest
+
+from conftest import load
+
+clock = load('drivers/clock.py')
+
+_PERIOD = 1 << 30  # ticks_ms on the ESP8266 wraps here, ticks_diff is in -_PERIOD / 2 .. _PERIOD / 2
+
+
+class Ticks:
+    def __init__(self):
+        self.ms = 0
+
+    def ticks_ms(self):
+        return self.ms % _PERIOD
+
+    def ticks_diff(self, a, b):
+        return (a - b + _PERIOD // 2) % _PERIOD - _PERIOD // 2
+
+    def ticks_add(self, a, b):
+        return (a + b) % _PERIOD
+
+
+class RTC:
+    """ DS3231 calendar registers that follow ticks.ms, from 2020-01-01. """
+
+    address = 0x68
+
+    def __init__(self, ticks):
+        self.ticks = ticks
+        self.i2c = self
+        self.reads = 0
+
+    def readfrom_mem_into(self, address, register, buf):
+        self.reads += 1
+        dt = clock.seconds2datetime(clock.datetime2seconds(2020, 1, 1) + self.ticks.ms // 1000)
+        bcd = lambda v: v + 6 * (v // 10)
+        buf[:] = bytes((bcd(dt[5]), bcd(dt[4]), bcd(dt[3]), dt[6] + 1, bcd(dt[2]), bcd(dt[1]), bcd(dt[0] - 2000)))
+
+
+@pytest.fixture
+def ticks(monkeypatch):
+    ticks = Ticks()
+    monkeypatch.setattr(clock, 'time', types.SimpleNamespace(ticks_ms=ticks.ticks_ms, ticks_diff=ticks.ticks_diff, ticks_add=ticks.ticks_add))
+    return ticks
+
+
+def test_counts_on(ticks):
+    rtc = RTC(ticks)
+    c = clock.Clock(rtc, resync=3600)
+    ticks.ms += 59 * 60 * 1000 + 1500
+    assert c.datetime() == (2020, 1, 1, 0, 59, 1, 2) and rtc.reads == 1
+    ticks.ms += 3600 * 1000
+    assert c.datetime() == (2020, 1, 1, 1, 59, 1, 2) and rtc.reads == 2
+
+
+@pytest.mark.parametrize('days', [6.3, 10, 12.4])
+def test_ticks_wrap(ticks, days):
+    # Nothing asked for the time in longer than ticks_diff can tell: it must read the DS3231 instead of counting on.
+    rtc = RTC(ticks)
+    c = clock.Clock(rtc)
+    ticks.ms += int(days * 86400 * 1000)
+    assert c.time() == clock.datetime2seconds(2020, 1, 1) + ticks.ms // 1000
+    assert rtc.reads == 2
@@ -0,0 +1,38 @@
+# Shared setup for the host-side tests (and bench/): what MicroPython and the board provide, and loading repo modules.
+# Imported by pytest before any test, the tests and benchmarks take load from here: from conftest import load
+
+import os
+import sys
+import types
+import builtins
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+builtins.const = getattr(builtins, 'const', lambda x: x)  # MicroPython only
+
+boot = types.ModuleType('boot')  # boot.py only runs on the board
+boot.UUID = '0123456789ab'
+boot.PYTHON_VERSION = 'micropython/1.8.6'
+boot.wlan = types.SimpleNamespace(isconnected=lambda: True)
+sys.modules.setdefault('boot', boot)
+
+
+def load(path, name=None, **modules):
+    """
+    The module at path (from the root of the repo) under name, by default its file name.
+    modules go in sys.modules only while it loads, eg http=... so it imports http.py and not the standard library.
+    """
+    saved = {k: sys.modules.get(k) for k in modules}
+    sys.modules.update(modules)
+    try:
+        spec = importlib.util.spec_from_file_location(name or os.path.splitext(os.path.basename(path))[0], os.path.join(ROOT, path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                del sys.modules[k]
+            else:
+                sys.modules[k] = v
+    return module
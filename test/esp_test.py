@@ -0,0 +1,178 @@
+# Host-side tests for esp.py, against fake boards on pseudo terminals (see fake_device.py)
+# Run with: python -m pytest test/esp_test.py
+
+import os
+import sys
+import types
+import socket
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'test'))
+
+wifi = types.ModuleType('wifi')  # Not in git, has the WiFi credentials for boot.py
+wifi.WIFI_SSID = 'ssid'
+wifi.WIFI_PASS = 'pass'
+sys.modules.setdefault('wifi', wifi)
+
+import esp
+from fake_device import Device, Pty, WebReplServer, recv_frame
+
+
+@pytest.fixture
+def board(request):
+    """ Esp connected to a fake board, request.param is the firmware """
+    device = Pty(Device(firmware=getattr(request, 'param', 'paste'), window=32))
+    board = esp.Esp(device.port, 115200, timeout=2)
+    board.device = device.device
+    yield board
+    board.reset()
+    device.close()
+
+
+@pytest.mark.parametrize('board', ['paste', 'nopaste', 'old'], indirect=True)
+def test_exec(board):
+    assert board.exec_('print(6 * 7)') == b'42\n'
+    # Once the firmware said no, raw-paste isn't tried again.
+    assert board.raw_paste == (board.device.firmware == 'paste')
+    assert board.exec_('print("again")') == b'again\n'
+
+
+def test_exec_error(board):
+    with pytest.raises(RuntimeError, match='ZeroDivisionError'):
+        board.exec_('1 / 0')
+    assert board.exec_('print(1)') == b'1\n'
+
+
+def test_paste_flow_control(board):
+    # Many windows of 32 bytes, the host has to wait for every window increment.
+    code = ''.join('x{} = {}\n'.format(i, i) for i in range(200)) + 'print(x199)'
+    assert board.exec_(code) == b'199\n'
+    assert board.device.execs[-1] == code.encode('utf8')
+
+
+@pytest.mark.parametrize('board', ['paste', 'old'], indirect=True)
+@pytest.mark.parametrize('compress', [True, False])
+def test_save_and_read_file(board, compress):
+    data = bytes(range(256)) * 8 + os.urandom(500)
+    board.compress = compress
+    board.save_file('data.bin', data)
+    assert board.device.files['data.bin'] == data
+    assert 'data.bin.z' not in board.device.files
+    assert board.read_file('data.bin') == data
+
+
+def test_deploy(board):
+    files = {'boot.py': b'# boot', 'app.py': b'print("app")', 'driver.py': b'# driver'}
+    assert board.deploy(files) == (['boot.py', 'app.py', 'driver.py'], [])
+    assert board.deploy(files) == ([], [])
+    assert board.deploy(dict(files, **{'app.py': b'print("app 2")'})) == (['app.py'], [])
+    assert board.device.files['app.py'] == b'print("app 2")'
+
+    # A tracked file removed by hand must not stop the deploy, or every later one.
+    del board.device.files['driver.py']
+    del files['driver.py']
+    assert board.deploy(files)[1] == ['driver.py']
+    assert board.manifest() == {name: esp.file_hash(data) for name, data in files.items()}
+    assert board.deploy(files) == ([], [])
+
+
+def test_fleet(capsys):
+    devices = [Pty(Device(firmware=firmware)) for firmware in ('paste', 'nopaste', 'old')]
+    dead = Pty(Device(), dead=True)
+    files = {'boot.py': b'# boot', 'app.py': b'print("app")' * 100}
+    try:
+        results = esp.fleet([d.port for d in devices] + [dead.port], 115200, files, timeout=1)
+        for d in devices:
+            assert results[d.port][:3] == (None, 2, 0)
+            assert d.device.files['app.py'] == files['app.py']
+            assert d.device.resets == 1
+        assert isinstance(results[dead.port][0], RuntimeError)
+
+        assert esp.summary(results, 1.5) == 1
+        out = capsys.readouterr().out
+        assert '{}: FAILED: Timeout'.format(dead.port) in out
+        assert '3 of 4 devices OK in 1.50s' in out
+    finally:
+        for d in devices + [dead]:
+            d.close()
+
+
+@pytest.fixture
+def webrepl():
+    """ WebRepl connected to a fake board behind a local WebREPL server """
+    server = WebReplServer(Device(window=64))
+    board = esp.connect('ws://127.0.0.1:{}'.format(server.port), 115200, password='secret', timeout=2)
+    board.server = server
+    yield board
+    board.reset()
+    server.close()
+
+
+@pytest.mark.parametrize('n', [0, 125, 126, 0xFFFF, 0x10000])
+def test_websocket_frame(n):
+    a, b = socket.socketpair()
+    data = os.urandom(n)
+    a.sendall(esp.WebSocket.frame(data, True) + esp.WebSocket.frame(b'text', False))
+    assert recv_frame(b) == (0x2, data)
+    assert recv_frame(b) == (0x1, b'text')
+    a.close()
+    b.close()
+
+
+def test_manifest_verify(board):
+    assert board.manifest(verify=True) == {}
+    board.device.dirs.add('lib')
+    assert board.manifest(verify=True) == {}
+    board.device.files['app.py'] = b'print("app")'
+    assert board.manifest(verify=True) == {'app.py': esp.file_hash(b'print("app")')}
+    # Nothing left behind in the REPL globals.
+    assert not {'h', 'b', 'm', 'd', 'f', 'k', 'n'} & set(board.device.globals)
+
+
+def test_webrepl_handshake():
+    server = WebReplServer(Device(), bad_accept=True)
+    with pytest.raises(RuntimeError, match='Sec-WebSocket-Accept'):
+        esp.connect('ws://127.0.0.1:{}'.format(server.port), 115200, password='secret', timeout=2)
+    with pytest.raises(ValueError, match='password'):
+        esp.connect('ws://127.0.0.1:{}'.format(server.port), 115200, timeout=2)
+    server.close()
+
+
+def test_webrepl_exec(webrepl):
+    # The server pings before the password prompt.
+    assert webrepl.server.pongs == [b'ping']
+    code = ''.join('x{} = {}\n'.format(i, i) for i in range(100)) + 'print(x99)'
+    assert webrepl.exec_(code) == b'99\n'
+    with pytest.raises(RuntimeError, match='NameError'):
+        webrepl.exec_('print(nope)')
+
+
+def test_webrepl_files(webrepl):
+    files = webrepl.server.device.files
+    data = os.urandom(70000)
+    webrepl.save_file('small.bin', data[:3000])
+    assert files['small.bin'] == data[:3000]
+    assert (0x2, 1024) in webrepl.server.frames
+
+    # One frame with a 64 bit length out, 16 bit length frames back (30000 byte chunks).
+    webrepl.chunk_size = len(data)
+    webrepl.save_file('big.bin', data)
+    assert files['big.bin'] == data
+    assert (0x2, len(data)) in webrepl.server.frames
+    assert webrepl.read_file('big.bin') == data
+    assert webrepl.read_file('small.bin') == data[:3000]
+
+    with pytest.raises(RuntimeError, match='missing.bin'):
+        webrepl.read_file('missing.bin')
+    with pytest.raises(RuntimeError, match='at most 64 bytes'):
+        webrepl.save_file('x' * 65, b'')
+
+
+def test_webrepl_deploy(webrepl):
+    files = {'boot.py': b'# boot', 'app.py': b'print("app")'}
+    assert webrepl.deploy(files) == (['boot.py', 'app.py'], [])
+    assert webrepl.deploy(files) == ([], [])
+    assert webrepl.server.device.files['app.py'] == files['app.py']
@@ -0,0 +1,360 @@
+# Fake MicroPython board for the host-side tests of esp.py
+# Copyright (c) 2016 Dries007
+# License: MIT
+
+# The REPL side of a board: friendly REPL, raw REPL and (depending on the firmware) raw-paste mode.
+# Code sent to it runs under CPython, with the few MicroPython modules esp.py and upload.py use on top of a dict of files.
+# Device is only the byte protocol, Pty puts one on a pseudo terminal so serial.Serial can open it,
+# WebReplServer puts one behind a local WebREPL.
+#
+#   device = Pty(Device(firmware='old'))
+#   esp = Esp(device.port, 115200)
+
+import io
+import os
+import pty
+import tty
+import zlib
+import types
+import base64
+import socket
+import struct
+import select
+import hashlib
+import binascii
+import threading
+import traceback
+
+RAW_PROMPT = b'raw REPL; CTRL-B to exit\r\n>'
+
+
+class _File:
+    """ A file in Device.files, written back when it's closed. """
+
+    def __init__(self, files, name, mode):
+        self.files = files
+        self.name = name
+        self.mode = mode
+        if 'w' in mode:
+            data = b''
+        elif name in files:
+            data = files[name]
+        else:
+            raise OSError(2, 'ENOENT')
+        self.io = io.BytesIO(data) if 'b' in mode else io.StringIO(data.decode('utf8'))
+
+    def __getattr__(self, name):
+        return getattr(self.io, name)
+
+    def close(self):
+        if 'w' in self.mode:
+            data = self.io.getvalue()
+            self.files[self.name] = data if isinstance(data, bytes) else data.encode('utf8')
+
+
+class _DecompIO:
+    """ uzlib.DecompIO """
+
+    def __init__(self, f, wbits):
+        self.f = f
+        self.d = zlib.decompressobj(wbits)
+        self.buffer = b''
+
+    def readinto(self, buffer):
+        while len(self.buffer) < len(buffer) and not self.d.eof:
+            data = self.f.read(64)
+            self.buffer += self.d.decompress(data) if data else self.d.flush()
+            if not data:
+                break
+        n = min(len(buffer), len(self.buffer))
+        buffer[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+class Device:
+    """
+    The byte protocol of a board. feed() takes what the host sends and returns the answer.
+    firmware: 'paste' has raw-paste, 'nopaste' knows the command but refuses it (R\\x00), 'old' doesn't know it at all.
+    """
+
+    def __init__(self, firmware='paste', window=32, files=None):
+        self.firmware = firmware
+        self.window = window
+        self.files = {} if files is None else files
+        self.dirs = set()  # Directories: listed, but can't be opened
+        self.mode = 'friendly'
+        self.buffer = b''
+        self.received = 0  # Raw-paste bytes since the last window increment
+        self.resets = 0
+        self.globals = None
+        self.execs = []
+
+    def _modules(self):
+        files = self.files
+
+        def remove(name):
+            if name not in files:
+                raise OSError(2, 'ENOENT')
+            del files[name]
+
+        return {
+            'gc': types.SimpleNamespace(collect=lambda: None, mem_free=lambda: 30000),
+            'ubinascii': binascii,
+            'uhashlib': hashlib,
+            'uzlib': types.SimpleNamespace(DecompIO=_DecompIO),
+            'uos': types.SimpleNamespace(remove=remove, listdir=lambda: list(files) + sorted(self.dirs)),
+            'os': types.SimpleNamespace(remove=remove, listdir=lambda: list(files) + sorted(self.dirs)),
+        }
+
+    def _open(self, name, mode='r'):
+        if name in self.dirs:
+            raise OSError(21, 'EISDIR')
+        return _File(self.files, name, mode)
+
+    def run(self, code):
+        """ Run code like the device would, returns (output, error). Globals stay, like on the REPL. """
+        self.execs.append(code)
+        out = io.StringIO()
+        if self.globals is None:
+            modules = self._modules()
+            builtins = dict(vars(__builtins__) if isinstance(__builtins__, types.ModuleType) else __builtins__)
+            builtins['__import__'] = lambda name, *args, **kwargs: modules[name]
+            builtins['open'] = self._open
+            self.globals = {'__builtins__': builtins}
+        self.globals['__builtins__']['print'] = lambda *args, **kwargs: print(*args, file=out, **kwargs)
+        try:
+            exec(code.decode('utf8'), self.globals)
+        except Exception:
+            return out.getvalue().encode('utf8'), traceback.format_exc(limit=0).encode('utf8')
+        return out.getvalue().encode('utf8'), b''
+
+    def _exec(self):
+        out, err = self.run(self.buffer)
+        self.buffer = b''
+        return out + b'\x04' + err + b'\x04>'
+
+    def feed(self, data):
+        answer = b''
+        for b in data:
+            answer += self._byte(bytes((b,)))
+        return answer
+
+    def _byte(self, b):
+        if self.mode == 'friendly':
+            if b == b'\x01':
+                self.mode = 'raw'
+                self.buffer = b''
+                return b'\r\n' + RAW_PROMPT
+            if b == b'\x04':
+                self.resets += 1
+                self.globals = None
+                return b'MPY: soft reboot\r\n>>> '
+            if b == b'\x03':
+                return b'\r\n>>> '
+            return b
+        if self.mode == 'raw':
+            if b == b'\x05' and not self.buffer and self.firmware != 'old':
+                self.mode = 'command'
+                return b''
+            if b == b'\x01':
+                # Old firmware ends up here after \x05A\x01 too, as the \x05A is only line buffer.
+                self.buffer = b''
+                return RAW_PROMPT
+            if b == b'\x02':
+                self.mode = 'friendly'
+                return b'\r\n>>> '
+            if b == b'\x03':
+                self.buffer = b''
+                return b''
+            if b == b'\x04':
+                return b'OK' + self._exec()
+            self.buffer += b
+            return b''
+        if self.mode == 'command':
+            self.buffer += b
+            if len(self.buffer) < 2:
+                return b''
+            command, self.buffer = self.buffer, b''
+            if command != b'A\x01' or self.firmware != 'paste':
+                self.mode = 'raw'
+                return b'R\x00'
+            self.mode = 'paste'
+            self.received = 0
+            return b'R\x01' + self.window.to_bytes(2, 'little')
+        # Raw-paste
+        if b == b'\x04':
+            self.mode = 'raw'
+            return b'\x04' + self._exec()
+        self.buffer += b
+        self.received += 1
+        if self.received == self.window:
+            self.received = 0
+            return b'\x01'
+        return b''
+
+
+class Pty:
+    """ Puts a Device on a pseudo terminal, port is the name to open. dead=True never answers (a board that hangs). """
+
+    def __init__(self, device, dead=False):
+        self.device = device
+        self.dead = dead
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.port = os.ttyname(slave)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            if not select.select([self.master], [], [], 0.05)[0]:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            answer = b'' if self.dead else self.device.feed(data)
+            if answer:
+                os.write(self.master, answer)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def recv_frame(sock):
+    """ One WebSocket frame from sock, unmasked: (opcode, payload). None when the connection is gone. """
+    def exact(n):
+        data = b''
+        while len(data) < n:
+            part = sock.recv(n - len(data))
+            if not part:
+                raise EOFError
+            data += part
+        return data
+
+    try:
+        op, n = exact(2)
+        mask = n & 0x80
+        n &= 0x7F
+        if n == 126:
+            n = struct.unpack('>H', exact(2))[0]
+        elif n == 127:
+            n = struct.unpack('>Q', exact(8))[0]
+        key = exact(4) if mask else b'\0\0\0\0'
+        data = bytes(b ^ key[i % 4] for i, b in enumerate(exact(n))) if any(key) else exact(n)
+    except (EOFError, OSError):
+        return None
+    return op & 0x0F, data
+
+
+def frame(op, data):
+    """ A server frame (not masked) """
+    n = len(data)
+    if n < 126:
+        return bytes((0x80 | op, n)) + data
+    if n < 0x10000:
+        return bytes((0x80 | op, 126)) + struct.pack('>H', n) + data
+    return bytes((0x80 | op, 127)) + struct.pack('>Q', n) + data
+
+
+class WebReplServer:
+    """
+    A Device behind WebREPL: the WebSocket handshake, a ping, the password prompt, the REPL on text frames
+    and the PUT/GET file protocol on binary frames. GET sends get_chunk bytes per chunk.
+    With bad_accept, the handshake answer doesn't match the key, like something that isn't a WebSocket server.
+    """
+
+    def __init__(self, device, password='secret', get_chunk=30000, bad_accept=False):
+        self.device = device
+        self.bad_accept = bad_accept
+        self.password = password
+        self.get_chunk = get_chunk
+        self.pongs = []
+        self.frames = []  # (opcode, length) of every frame from the client
+        self.listen = socket.socket()
+        self.listen.bind(('127.0.0.1', 0))
+        self.listen.listen(1)
+        self.port = self.listen.getsockname()[1]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        self.listen.close()
+
+    def _run(self):
+        while True:
+            try:
+                c, _ = self.listen.accept()
+            except OSError:
+                return
+            with c:
+                try:
+                    self._serve(c)
+                except OSError:
+                    pass  # The client hung up
+
+    def _serve(self, c):
+        request = b''
+        while not request.endswith(b'\r\n\r\n'):
+            request += c.recv(1)
+        key = [line.split(b': ', 1)[1] for line in request.split(b'\r\n') if line.lower().startswith(b'sec-websocket-key')][0]
+        accept = base64.b64encode(hashlib.sha1(key + (b'x' if self.bad_accept else b'') + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+        c.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        c.sendall(frame(0x9, b'ping') + frame(0x1, b'Password: '))
+
+        text = b''
+        binary = b''
+        logged_in = False
+        transfer = None  # (op, name, size or data left)
+        while True:
+            received = recv_frame(c)
+            if received is None:
+                return
+            op, data = received
+            self.frames.append((op, len(data)))
+            if op == 0x8:
+                c.sendall(frame(0x8, b''))
+                return
+            if op == 0xA:
+                self.pongs.append(data)
+            elif op == 0x1 and not logged_in:
+                text += data
+                if text.endswith(b'\r'):
+                    if text[:-1] != self.password.encode('utf8'):
+                        c.sendall(frame(0x1, b'\r\nAccess denied\r\n'))
+                        return
+                    logged_in = True
+                    c.sendall(frame(0x1, b'\r\nWebREPL connected\r\n>>> '))
+            elif op == 0x1:
+                answer = self.device.feed(data)
+                if answer:
+                    c.sendall(frame(0x1, answer))
+            elif op == 0x2:
+                binary += data
+                if transfer is None and len(binary) >= 82:
+                    sig, op_, _, _, size, n, name = struct.unpack('<2sBBQLH64s', binary[:82])
+                    binary = binary[82:]
+                    name = name[:n].decode('utf8')
+                    if op_ == 2 and name not in self.device.files:
+                        c.sendall(frame(0x2, b'WB\x01\x00'))
+                        continue
+                    c.sendall(frame(0x2, b'WB\x00\x00'))
+                    transfer = (op_, name, size if op_ == 1 else self.device.files[name])
+                if transfer is not None and transfer[0] == 1 and len(binary) >= transfer[2]:
+                    self.device.files[transfer[1]], binary = binary[:transfer[2]], binary[transfer[2]:]
+                    c.sendall(frame(0x2, b'WB\x00\x00'))
+                    transfer = None
+                while transfer is not None and transfer[0] == 2 and binary[:1] == b'\0':
+                    binary = binary[1:]
+                    left = transfer[2]
+                    chunk, left = left[:self.get_chunk], left[self.get_chunk:]
+                    c.sendall(frame(0x2, struct.pack('<H', len(chunk)) + chunk))
+                    transfer = (2, transfer[1], left)
+                    if not chunk:
+                        c.sendall(frame(0x2, b'WB\x00\x00'))
+                        transfer = None
@@ -0,0 +1,104 @@
+# Host-side tests for http.py, against a local server
+# Run with: python -m pytest test/http_test.py
+
+import io
+import socket
+import threading
+
+import pytest
+
+from conftest import load
+
+# As mpy_http, so it doesn't clash with the http package of the standard library.
+http = load('http.py', 'mpy_http')
+
+
+class Server:
+    """
+    Answers every request with 200 and Connection: keep-alive, but closes the connection after requests_per_connection
+    requests anyway, like a server with a short keep-alive timeout. The requests are kept, as (head, body).
+    """
+
+    def __init__(self, requests_per_connection=1):
+        self.requests_per_connection = requests_per_connection
+        self.requests = []
+        self.listen = socket.socket()
+        self.listen.bind(('127.0.0.1', 0))
+        self.listen.listen(4)
+        self.port = self.listen.getsockname()[1]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        self.listen.close()
+
+    def _run(self):
+        while True:
+            try:
+                c, _ = self.listen.accept()
+            except OSError:
+                return
+            c.settimeout(2)  # A body that never comes fails the test instead of hanging it
+            with c, c.makefile('rb') as f:
+                try:
+                    self._serve(c, f)
+                except OSError:
+                    pass
+
+    def _serve(self, c, f):
+        for _ in range(self.requests_per_connection):
+            head = [f.readline()]
+            while head[-1] not in (b'\r\n', b''):
+                head.append(f.readline())
+            length = [int(line.split(b':')[1]) for line in head if line.lower().startswith(b'content-length')]
+            body = f.read(length[0]) if length else b''
+            self.requests.append((b''.join(head), body))
+            c.sendall(b'HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nContent-Length: 2\r\n\r\nok')
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close()
+
+
+def test_serialize():
+    headers_ = http._headers('example.com', b'12345', {'X-Count': 0, 'X-Text': 'caf\xe9'})
+    mv, n = http._prepare('POST', '/api', headers_)
+    assert bytes(mv[:n]) == (b'POST /api HTTP/1.1\r\nHost: example.com\r\nUser-Agent: micropython/1.8.6\r\nConnection: close\r\n'
+                             b'UUID: 0123456789ab\r\nContent-Length: 5\r\nX-Count: 0\r\nX-Text: caf\xc3\xa9\r\n\r\n')
+
+
+@pytest.mark.parametrize('value', [0, 7, 10, 99, 1234567890])
+def test_put_int(value):
+    buf = bytearray(b'-' * 16)
+    assert http._put(memoryview(buf), 2, value) == 2 + len(str(value))
+    assert buf == b'--' + str(value).encode() + b'-' * (14 - len(str(value)))
+
+
+@pytest.mark.parametrize('value, text', [(True, b'True'), (False, b'False'), (-12, b'-12'), (1.5, b'1.5'), (None, b'None')])
+def test_put_other(value, text):
+    # Like the '%s' the headers used to be formatted with.
+    headers_ = http._headers('example.com', None, {'X-Value': value})
+    mv, n = http._prepare('GET', '/', headers_)
+    assert b'\r\nX-Value: ' + text + b'\r\n' in bytes(mv[:n])
+
+
+def test_prepare_grows():
+    headers_ = http._headers('example.com', None, {'X-Big': 'x' * 2000})
+    mv, n = http._prepare('GET', '/', headers_)
+    assert n > 2000 and bytes(mv[n - 8:n]) == b'xxxx\r\n\r\n'
+
+
+@pytest.mark.parametrize('body', [b'x' * 100, b'y' * 3000])
+def test_session_retry_file_body(server, body):
+    session = http.Session()
+    with session.request('POST', '127.0.0.1', '/first', 'a', port=server.port) as r:
+        assert r.read() == b'ok'
+    # The pooled connection is closed by now, the file is sent again on a new one.
+    f = io.BytesIO(b'skipped' + body)
+    f.seek(7)
+    with session.request('POST', '127.0.0.1', '/second', f, port=server.port) as r:
+        assert r.read() == b'ok'
+    assert server.requests[-1][1] == body
+    assert session.stats()['handshakes'] == 2
@@ -0,0 +1,21 @@
+import esp
+import machine
+esp.osdebug(None)
+machine.freq(160000000)
+
+import time
+import lcdi2c
+
+TEXT = b'0123456789ABCDEF'
+ROUNDS = 50
+
+for freq in (100000, 400000):
+    i2c = machine.I2C(machine.Pin(12), machine.Pin(13), freq=freq)
+    lcd = lcdi2c.LCD(i2c, freq=freq)
+    lcd.init()
+    start = time.ticks_us()
+    for i in range(ROUNDS):
+        lcd.pos(0, i & 1)
+        lcd.write(TEXT, lcd.bit_rs)
+    us = time.ticks_diff(time.ticks_us(), start)
+    print("%d kHz: %d chars/s (%d us/char, with a pos() per line)" % (freq // 1000, len(TEXT) * ROUNDS * 1000000 // us, us // (len(TEXT) * ROUNDS)))
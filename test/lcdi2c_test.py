@@ -15,7 +15,9 @@ for i in range(0, 0xFF, 32):
 
 # @formatter:off
 
-lcd.text('\x00\x01')
+lcd.clear()
+lcd.text(b'\x00\x01')
+lcd.flush()
 
 while True:
     lcd.custom_char(0, [
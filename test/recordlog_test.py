@@ -0,0 +1,142 @@
+# Host-side tests for drivers/recordlog.py, through drivers/at24cxx.py on a fake EEPROM
+# Run with: python -m pytest test/recordlog_test.py
+
+import types
+import struct
+
+import pytest
+
+from conftest import load
+
+at24cxx = load('drivers/at24cxx.py')
+at24cxx.time = types.SimpleNamespace(ticks_ms=lambda: 0, ticks_diff=lambda a, b: a - b)  # The fake is never busy
+recordlog = load('drivers/recordlog.py')
+
+
+class PowerLoss(Exception):
+    pass
+
+
+class EEPROM:
+    """ AT24C32 on an I2C bus: a bytearray, erased to 0xFF. After cut more bytes written, the power goes out. """
+
+    def __init__(self, size=4096):
+        self.memory = bytearray(b'\xff' * size)
+        self.pointer = 0
+        self.cut = None
+
+    def scan(self):
+        return [0x57]
+
+    def writeto(self, address, buf):
+        if len(buf) == 2:  # Sets the address for the sequential reads, b'' is the ACK poll
+            self.pointer = buf[0] << 8 | buf[1]
+
+    def writeto_mem(self, address, memaddr, buf, addrsize=16):
+        for i, b in enumerate(bytes(buf)):
+            if self.cut is not None:
+                if not self.cut:
+                    raise PowerLoss()
+                self.cut -= 1
+            self.memory[memaddr + i] = b
+
+    def readfrom_into(self, address, buf):
+        for i in range(len(buf)):
+            buf[i] = self.memory[self.pointer % len(self.memory)]
+            self.pointer += 1
+
+    def readfrom(self, address, size):
+        buf = bytearray(size)
+        self.readfrom_into(address, buf)
+        return bytes(buf)
+
+
+@pytest.fixture
+def bus():
+    return EEPROM()
+
+
+def open_log(bus, size=4, length=512):
+    return recordlog.RecordLog(at24cxx.AT24CXX(bus), size, length=length)
+
+
+def data(seq, size=4):
+    return struct.pack('<I', seq * 7)[:size].ljust(size, b'\0')
+
+
+def fill(log, first, last):
+    for seq in range(first, last):
+        assert log.append(data(seq, log.size), timestamp=1000 + seq * 10) == seq
+
+
+# size 4: 2 records per page, with a gap. 22: exactly one page. 40: a record takes two pages.
+@pytest.mark.parametrize('size, slots', [(4, 32), (22, 16), (40, 8)])
+def test_reopen(bus, size, slots):
+    log = open_log(bus, size)
+    assert log.slots == slots and len(log) == 0 and list(log.latest(5)) == []
+    fill(log, 0, 5)
+    log = open_log(bus, size)
+    assert len(log) == 5 and log.seq == 4
+    assert list(log.latest(2)) == [(4, 1040, data(4, size)), (3, 1030, data(3, size))]
+    assert log.read(0) == (0, 1000, data(0, size)) and log.read(5) is None
+
+
+@pytest.mark.parametrize('size', [4, 22, 40])
+def test_wraparound(bus, size):
+    log = open_log(bus, size)
+    fill(log, 0, 2 * log.slots + 3)
+    log = open_log(bus, size)
+    newest = 2 * log.slots + 2
+    assert log.seq == newest and len(log) == log.slots
+    assert [r[0] for r in log.latest(log.slots + 5)] == list(range(newest, newest - log.slots, -1))
+    assert log.read(newest - log.slots) is None  # Overwritten
+    assert log.read(newest - log.slots + 1)[2] == data(newest - log.slots + 1, size)
+
+
+def test_crc_rejects(bus):
+    log = open_log(bus)
+    fill(log, 0, 4)
+    bus.memory[log._address(2) + 9] ^= 0x01
+    assert log.read(2) is None
+    assert [r[0] for r in log.latest(4)] == [3, 1, 0]
+
+
+def test_torn_newest(bus):
+    log = open_log(bus)
+    fill(log, 0, 6)
+    bus.cut = 5  # Power goes out in the middle of the 7th record
+    with pytest.raises(PowerLoss):
+        log.append(data(6), timestamp=1060)
+    bus.cut = None
+    log = open_log(bus)
+    assert log.seq == 5 and len(log) == 6
+    # The torn slot is simply written again.
+    fill(log, 6, 7)
+    assert [r[0] for r in open_log(bus).latest(3)] == [6, 5, 4]
+
+
+@pytest.mark.parametrize('size', [4, 40])
+def test_torn_oldest(bus, size):
+    log = open_log(bus, size)
+    fill(log, 0, log.slots + 3)
+    newest = log.slots + 2
+    bus.cut = log.record - 3  # Cut off just before the CRC of the next record, over the oldest one
+    with pytest.raises(PowerLoss):
+        log.append(data(newest + 1, size), timestamp=2000)
+    bus.cut = None
+    log = open_log(bus, size)
+    # The boot scan finds the newest good record, the oldest is gone and not counted.
+    assert log.seq == newest and len(log) == log.slots - 1
+    assert log.read(newest + 1 - log.slots) is None
+    assert [r[0] for r in log.latest(log.slots)] == list(range(newest, newest + 1 - log.slots, -1))
+    assert log.append(data(newest + 1, size), timestamp=2000) == newest + 1
+    assert len(open_log(bus, size)) == log.slots
+
+
+def test_since(bus):
+    log = open_log(bus)
+    fill(log, 0, log.slots + 10)  # Timestamps 1000, 1010, ... oldest left is seq 10
+    assert [r[0] for r in log.since(1255)] == list(range(26, log.slots + 10))
+    assert [r[0] for r in log.since(0)] == list(range(10, log.slots + 10))
+    assert list(log.since(9999)) == []
+    assert next(log.since(1100)) == (10, 1100, data(10))
@@ -0,0 +1,139 @@
+# Host-side tests for telemetry.py, on a FileStorage in a temporary directory
+# Run with: python -m pytest test/telemetry_test.py
+
+import types
+import struct
+
+import pytest
+
+from conftest import load
+
+# telemetry does import http, the batches go to a FakeSession here so any http module will do while it loads.
+telemetry = load('telemetry.py', http=types.ModuleType('http'))
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+
+    def read(self):
+        return b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """ Keeps the bodies it was sent, answers with status. """
+
+    def __init__(self, status=200):
+        self.status = status
+        self.bodies = []
+
+    def request(self, method, host, url, data, headers, port):
+        if self.status is None:
+            raise OSError('ECONNREFUSED')
+        self.bodies.append(bytes(data))
+        return FakeResponse(self.status)
+
+
+class Storage(telemetry.FileStorage):
+    """ FileStorage that remembers the offsets it wrote to. """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.writes = []
+
+    def write(self, offset, data):
+        self.writes.append(offset)
+        super().write(offset, data)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'telemetry.bin')
+
+
+def open_queue(path, size=4096, fmt='<If', session=None, **kwargs):
+    return telemetry.Telemetry(Storage(path, size), fmt, 'example.com', session=session or FakeSession(), **kwargs)
+
+
+def test_survives_reset(path):
+    q = open_queue(path)
+    for i in range(10):
+        q.append(i, i / 2)
+    q = open_queue(path)
+    assert len(q) == 10
+    assert q.records(10) == [(i, i / 2) for i in range(10)]
+
+
+def test_append_only_writes_its_slot(path):
+    q = open_queue(path, batch=4)
+    q.storage.writes = []
+    for i in range(10):
+        q.append(i, 0)
+    # No header or mark writes, every append is its own slot.
+    assert q.storage.writes == [telemetry._DATA + i * q.slot for i in range(1, 11)]
+    q.storage.writes = []
+    assert q.flush() == 10
+    assert len(q.storage.writes) == 1 and q.storage.writes[0] < telemetry._DATA
+    assert len(open_queue(path)) == 0
+
+
+def test_flush_batches(path):
+    session = FakeSession()
+    q = open_queue(path, session=session, batch=4)
+    for i in range(10):
+        q.append(i, 1.5)
+    assert q.flush() == 10
+    assert [len(body) // 8 for body in session.bodies] == [4, 4, 2]
+    assert [struct.unpack_from('<If', b''.join(session.bodies), i * 8) for i in range(10)] == [(i, 1.5) for i in range(10)]
+    q.append(10, 0)
+    assert open_queue(path).records(1) == [(10, 0)]
+
+
+def test_marks_round_robin(path):
+    q = open_queue(path)
+    offsets = []
+    for i in range(20):
+        q.append(i, 0)
+        q.storage.writes = []
+        q.flush()
+        offsets += q.storage.writes
+    assert sorted(set(offsets)) == [4 + 4 * i for i in range(telemetry._MARKS)]
+    assert len(open_queue(path)) == 0
+
+
+def test_full(path):
+    q = open_queue(path, size=telemetry._DATA + 5 * 8, fmt='<I')  # 5 slots of seq + '<I'
+    assert q.capacity == 5
+    for i in range(13):
+        q.append(i)
+    assert len(q) == 5 and q.dropped == 8
+    assert q.records(5) == [(i,) for i in range(8, 13)]
+    q = open_queue(path, size=telemetry._DATA + 5 * 8, fmt='<I')
+    assert q.records(5) == [(i,) for i in range(8, 13)]
+    # Over the wrap, in two reads.
+    assert q.flush() == 5
+    q.append(13)
+    assert open_queue(path, size=telemetry._DATA + 5 * 8, fmt='<I').records(1) == [(13,)]
+
+
+def test_failed_flush(path):
+    session = FakeSession(500)
+    q = open_queue(path, session=session)
+    q.append(1, 2)
+    assert q.flush() == 0 and len(q) == 1 and q.failures == 1
+    session.status = None
+    assert q.flush(force=True) == 0 and q.failures == 2
+    session.status = 204
+    assert q.flush(force=True) == 1 and len(q) == 0
+
+
+def test_other_format_is_cleared(path):
+    q = open_queue(path)
+    q.append(1, 2)
+    assert len(open_queue(path, fmt='<Ih')) == 0
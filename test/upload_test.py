@@ -0,0 +1,74 @@
+# Host-side tests for upload.py
+# Run with: python -m pytest test/upload_test.py
+
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import upload
+
+
+@pytest.fixture
+def no_minify(monkeypatch):
+    """ pyminifier isn't needed to test what goes around it. """
+    monkeypatch.setattr(upload, 'minify', lambda text: text)
+    monkeypatch.setattr(upload, 'tool_version', lambda: (upload.BUILD_VERSION, 'test'))
+
+
+def test_build_cache_key_ignores_objects(tmp_path, no_minify):
+    path = tmp_path / 'app.py'
+    path.write_text('print(DEBUG)\n')
+    cache = upload.Cache(str(tmp_path / 'cache'))
+    # What a --config module brings along, repr has the address of these in it.
+    first, second = ({'DEBUG': False, 'os': types.ModuleType('os'), 'helper': lambda: 0} for _ in range(2))
+    assert upload.build(str(path), first, cache)[1] == 'print(False)'
+    assert upload.build(str(path), second, cache)[1] == 'print(False)'
+    assert (cache.hits, cache.misses) == (1, 1)
+    upload.build(str(path), {'DEBUG': True}, cache)
+    assert cache.misses == 2
+
+
+@pytest.mark.parametrize('source, expected', [
+    ('f = lambda N: N + 1\ng = lambda x: x + N', 'f = lambda N: N + 1\ng = lambda x: x + 4'),
+    ('print([N for N in range(N)])', 'print([N for N in range(4)])'),
+    ('print({N: x for x in range(N) for N in range(x)})', 'print({N: x for x in range(4) for N in range(x)})'),
+    ('print(list((x + N for x in range(2))))', 'print(list((x + 4 for x in range(2))))'),
+    ('for N in range(3):\n    print(N)', 'for N in range(3):\n    print(N)'),
+    ('with open(N) as f:\n    print(N)', "with open(4) as f:\n    print(4)"),
+    ('with open(N) as N:\n    print(N)', 'with open(N) as N:\n    print(N)'),
+    ('try:\n    pass\nexcept OSError as N:\n    print(N)', 'try:\n    pass\nexcept OSError as N:\n    print(N)'),
+    ('def f():\n    for N in range(2):\n        print(N)', 'def f():\n    for N in range(2):\n        print(N)'),
+    ('def f():\n    try:\n        pass\n    except OSError as N:\n        print(N)', 'def f():\n    try:\n        pass\n    except OSError as N:\n        print(N)'),
+])
+def test_optimize_shadowing(source, expected):
+    assert upload.optimize(source, {'N': 4}) == expected
+
+
+def test_optimize_const_shadowing():
+    out = upload.optimize('_N = const(3)\nprint(_N, [_N for _N in range(_N)], lambda _N: _N)', {})
+    assert out == 'print(3, [_N for _N in range(3)], lambda _N: _N)'
+
+
+@pytest.mark.parametrize('source, expected', [
+    ('try:\n    x = 1\nfinally:\n    if DEBUG:\n        print(x)', 'x = 1'),
+    ('def f():\n    try:\n        return 1\n    finally:\n        if DEBUG:\n            print(1)', 'def f():\n    return 1'),
+    ('try:\n    x = 1\nexcept OSError:\n    if DEBUG:\n        print(x)', 'try:\n    x = 1\nexcept OSError:\n    pass'),
+    ('try:\n    if DEBUG:\n        x = 1\nfinally:\n    print(2)', 'try:\n    pass\nfinally:\n    print(2)'),
+])
+def test_optimize_try(source, expected):
+    out = upload.optimize(source, {'DEBUG': False})
+    compile(out, '<test>', 'exec')
+    assert out == expected
+
+
+def test_transfer_falls_back_to_plain():
+    noise = os.urandom(600)  # Deflate can't make this smaller
+    assert list(upload.transfer('x.mpy', noise, True)) == list(upload.transfer('x.mpy', noise, False))
+    text = b'print("hello")\n' * 100
+    blocks = list(upload.transfer('x.py', text, True))
+    assert 'uzlib' in blocks[-1] and upload.wire_size('x.py', text, True) < upload.wire_size('x.py', text, False)
@@ -1,43 +1,469 @@
 import os
-import re
+import ast
 import zlib
+import time
+import hashlib
+import binascii
+import tempfile
+import functools
 import importlib
+import subprocess
 
-import pyminifier.token_utils
-import pyminifier.minification
+# Deflate window of 2^10 = 1KB, that's how much RAM the device needs to decompress.
+WBITS = 10
+# Raw bytes per line, 384 bytes -> 512 base64 chars, small enough for the device to compile in one go.
+CHUNK = 384
+# Bump when the build steps change, so old cache entries are no longer used.
+BUILD_VERSION = 2
+CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.cache')
+MPY_CROSS = os.environ.get('MPY_CROSS', 'mpy-cross')
 
 
-def do(path, config):
-    with open(path, 'r') as f:
+def deflate(data):
+    c = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+    return c.compress(data) + c.flush()
+
+
+def transfer(name, data, compress=True, chunk=CHUNK):
+    """
+    Yields blocks of code that recreate file `name` with the content `data` (bytes) on the device.
+    With compress, the payload is deflated and send as base64, then inflated on the device in fixed size buffers.
+    Data that deflate doesn't make smaller (.mpy files that are already tight, tiny files) is sent plain anyway.
+    """
+    if compress:
+        deflated = deflate(data)
+        compress = len(deflated) < len(data)
+    if not compress:
+        yield 'import gc\ngc.collect()\nf = open({!r}, "wb")'.format(name)
+        for i in range(0, len(data), chunk):
+            yield 'f.write({!r})'.format(data[i:i + chunk])
+        yield 'f.close()\ndel f\ngc.collect()'
+        return
+
+    data = deflated
+    yield 'import gc\nimport ubinascii\ngc.collect()\nf = open({!r}, "wb")\nw = lambda s: f.write(ubinascii.a2b_base64(s))'.format(name + '.z')
+    for i in range(0, len(data), chunk):
+        yield 'w({!r})'.format(binascii.b2a_base64(data[i:i + chunk], newline=False).decode('ascii'))
+    yield ('f.close()\n'
+           'import uos\n'
+           'import uzlib\n'
+           'f = open({z!r}, "rb")\n'
+           'o = open({name!r}, "wb")\n'
+           'd = uzlib.DecompIO(f, {wbits})\n'
+           'b = bytearray(256)\n'
+           'm = memoryview(b)\n'
+           'n = d.readinto(b)\n'
+           'while n:\n'
+           ' o.write(m[:n])\n'
+           ' n = d.readinto(b)\n'
+           'o.close()\n'
+           'f.close()\n'
+           'uos.remove({z!r})\n'
+           'del f, o, d, b, m, n, w\n'
+           'gc.collect()').format(name=name, z=name + '.z', wbits=WBITS)
+
+
+def wire_size(name, data, compress=True):
+    return sum(len(block) + 1 for block in transfer(name, data, compress))
+
+
+def bench(paths, baudrate=115200):
+    """
+    Compare bytes on the wire for plain vs compressed transfer. Nothing is sent: the times are estimates, the bytes at
+    baudrate with 10 bits per byte, without the time the device needs to run the code.
+    """
+    print('{:20} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('File', 'Size', 'Plain', 'Est.', 'Deflate', 'Est.'))
+    totals = [0, 0, 0]
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
         name = os.path.basename(path)
+        plain = wire_size(name, data, False)
+        packed = wire_size(name, data, True)
+        for i, v in enumerate((len(data), plain, packed)):
+            totals[i] += v
+        print('{:20} {:8d} {:8d} {:7.2f}s {:8d} {:7.2f}s'.format(name, len(data), plain, plain * 10 / baudrate, packed, packed * 10 / baudrate))
+    print('{:20} {:8d} {:8d} {:7.2f}s {:8d} {:7.2f}s'.format('Total', totals[0], totals[1], totals[1] * 10 / baudrate, totals[2], totals[2] * 10 / baudrate))
+    print('Est. = estimated line time at {} baud, 10 bits per byte, not measured.'.format(baudrate))
+
+
+class Cache:
+    """
+    On-disk cache of build output, one file per key.
+    When the total size goes over max_size, the least recently used entries are removed.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_size=4 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(part if isinstance(part, bytes) else repr(part).encode('utf8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, key):
+        file = os.path.join(self.path, key)
+        try:
+            with open(file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(file)  # mtime = last use, for eviction
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        tmp = os.path.join(self.path, key + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.path, key))
+        self.evict()
+
+    def evict(self):
+        entries = [e for e in os.scandir(self.path) if e.is_file() and not e.name.endswith('.tmp')]
+        total = sum(e.stat().st_size for e in entries)
+        for e in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self.max_size:
+                break
+            total -= e.stat().st_size
+            os.remove(e.path)
+            self.evictions += 1
+
+    def stats(self):
+        return 'Cache: {} hits, {} misses, {} evicted'.format(self.hits, self.misses, self.evictions)
+
+
+_LITERALS = (bool, int, float, complex, str, bytes, type(None))
+
+
+def _literal(value):
+    if isinstance(value, tuple):
+        return all(_literal(v) for v in value)
+    return isinstance(value, _LITERALS)
+
+
+def _constant(node):
+    return isinstance(node, ast.Constant)
+
+
+def _arguments(args):
+    names = {a.arg for a in args.posonlyargs + args.args + args.kwonlyargs}
+    names.update(a.arg for a in (args.vararg, args.kwarg) if a is not None)
+    return names
+
+
+_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+def _scope(nodes):
+    """ All nodes in the scope of the statements nodes, nested functions, classes and comprehensions not included. """
+    todo = list(nodes)
+    while todo:
+        node = todo.pop()
+        yield node
+        if not isinstance(node, _SCOPES):
+            todo.extend(ast.iter_child_nodes(node))
+
+
+def _bound(nodes):
+    """ Names bound in the scope of the statements nodes: assigned, loop/with/except targets, imports, def and class. """
+    names = set()
+    for node in _scope(nodes):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((a.asname or a.name).split('.')[0] for a in node.names)
+    return names
+
+
+def _targets(node):
+    """ Names bound by a for, with or except (as) statement. """
+    if isinstance(node, (ast.For, ast.AsyncFor)):
+        targets = [node.target]
+    elif isinstance(node, (ast.With, ast.AsyncWith)):
+        targets = [item.optional_vars for item in node.items if item.optional_vars is not None]
+    elif isinstance(node, ast.ExceptHandler):
+        return {node.name} if node.name else set()
+    else:
+        return set()
+    return {n.id for target in targets for n in ast.walk(target) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+
+
+class Optimizer(ast.NodeTransformer):
+    """
+    Compile time evaluation, like the MicroPython compiler does for const() but for everything it can prove is constant:
+    - config values replace the names (and "NAME" placeholder strings) as real constants
+    - module level NAME = const(...) is folded into every use, and dropped if it's _private (like MicroPython does)
+    - constant expressions are folded, and if/else branches that can never run are removed
+    """
+
+    def __init__(self, config):
+        self.names = {k: v for k, v in config.items() if _literal(v)}
+        self.placeholders = {k: v for k, v in self.names.items() if isinstance(v, str)}
+
+    def visit_Module(self, node):
+        # A loop, with or except target at module level rebinds the name, so it isn't constant.
+        rebound = {n for stmt in _scope(node.body) for n in _targets(stmt)}
+        self.names = {k: v for k, v in self.names.items() if k not in rebound}
+        body = []
+        for stmt in node.body:
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+                name = stmt.targets[0].id
+                value = self.visit(stmt.value)
+                if name in self.names:
+                    value = ast.Constant(self.names[name])
+                elif isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and value.func.id == 'const' \
+                        and len(value.args) == 1 and _constant(value.args[0]) and name not in rebound:
+                    self.names[name] = value.args[0].value
+                    if name.startswith('_'):
+                        continue
+                stmt.value = value
+                body.append(stmt)
+                continue
+            stmt = self.visit(stmt)
+            if isinstance(stmt, list):
+                body.extend(stmt)
+            elif stmt is not None:
+                body.append(stmt)
+        node.body = body
+        return node
+
+    def _scoped(self, node, local):
+        # Visit node with the names in local shadowing the constants.
+        saved = self.names
+        self.names = {k: v for k, v in saved.items() if k not in local}
+        self.generic_visit(node)
+        self.names = saved
+        return node
+
+    def visit_FunctionDef(self, node):
+        # Parameters and local assignments shadow module level constants.
+        local = _arguments(node.args) | _bound(node.body)
+        local.difference_update(n for g in _scope(node.body) if isinstance(g, (ast.Global, ast.Nonlocal)) for n in g.names)
+        return self._scoped(node, local)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        return self._scoped(node, _arguments(node.args))
+
+    def visit_ListComp(self, node):
+        # The targets shadow constants in the whole comprehension, except in the first iterable: that one runs outside.
+        first = node.generators[0]
+        outer = self.visit(first.iter)
+        first.iter = None
+        self._scoped(node, {n.id for g in node.generators for n in ast.walk(g.target) if isinstance(n, ast.Name)})
+        first.iter = outer
+        return node
+
+    visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_ListComp
 
+    def visit_Try(self, node):
+        self.generic_visit(node)
+        # try/finally with nothing left in the finally block isn't valid Python, the try block can go without it.
+        if not node.handlers and not node.finalbody:
+            return node.body
+        return node
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.names:
+            return ast.copy_location(ast.Constant(self.names[node.id]), node)
+        return node
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, str) and node.value in self.placeholders:
+            return ast.copy_location(ast.Constant(self.placeholders[node.value]), node)
+        return node
+
+    def _fold(self, node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Pow, ast.LShift)) and not (_constant(node.right) and isinstance(node.right.value, int) and node.right.value <= 64):
+            return node
+        try:
+            value = eval(compile(ast.fix_missing_locations(ast.Expression(node)), '<fold>', 'eval'), {'__builtins__': {}})
+        except Exception:
+            return node
+        if isinstance(value, (str, bytes, tuple)) and len(value) > 256:
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        return self._fold(node) if _constant(node.left) and _constant(node.right) else node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        return self._fold(node) if _constant(node.operand) else node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        return self._fold(node) if _constant(node.left) and all(_constant(c) for c in node.comparators) else node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        values = list(node.values)
+        # Only leading constants can be decided: (True and x) -> x, (False and x) -> False, ...
+        while len(values) > 1 and _constant(values[0]):
+            if bool(values[0].value) == isinstance(node.op, ast.Or):
+                return values[0]
+            values.pop(0)
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        if _constant(node.test):
+            return node.body if node.test.value else node.orelse
+        return node
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        if _constant(node.test):
+            return (node.body if node.test.value else node.orelse) or None
+        return node
+
+    def generic_visit(self, node):
+        super().generic_visit(node)
+        return self._nonempty(node)
+
+    @staticmethod
+    def _nonempty(node):
+        # Removing a branch can leave a block without statements, which isn't valid Python.
+        if isinstance(getattr(node, 'body', None), list) and not node.body:
+            node.body.append(ast.Pass())
+        return node
+
+
+def optimize(text, config):
+    """ Config substitution, constant folding and dead branch removal on the AST. Returns source text. """
+    tree = Optimizer(config).visit(ast.parse(text))
+    return ast.unparse(ast.fix_missing_locations(tree))
+
+
+def minify(text):
+    import pyminifier.token_utils
+    import pyminifier.minification
+
+    class Bunch:
+        def __init__(self, **kwds):
+            self.__dict__.update(kwds)
+
+    return pyminifier.minification.minify(pyminifier.token_utils.listified_tokenizer(text), Bunch(tabs=False))
+
+
+def tool_version():
+    import pyminifier
+    return BUILD_VERSION, pyminifier.__version__
+
+
+def build(path, config, cache=None):
+    """ Config substitution + minification of the file at path. Returns (original, minified) as text. """
+    with open(path, 'r') as f:
+        original = f.read()
+
+    key = None
+    if cache is not None:
+        # Only the literal values take part in the build, other config values (modules, functions, ...) would put
+        # their address in the key through repr.
+        key = Cache.key(original, sorted(Optimizer(config).names.items()), tool_version())
+        minified = cache.get(key)
+        if minified is not None:
+            return original, minified.decode('utf8')
+
+    minified = minify(optimize(original, config))
+
+    if cache is not None:
+        cache.put(key, minified.encode('utf8'))
+    return original, minified
+
+
+@functools.lru_cache()
+def mpy_cross_version():
+    return subprocess.run([MPY_CROSS, '--version'], stdout=subprocess.PIPE, check=True).stdout.decode('utf8').strip()
+
+
+def compile_mpy(name, source, args=(), cache=None):
+    """ Cross compile source (text) to .mpy bytecode, so the device doesn't need to compile it at import time. """
+    key = None
+    if cache is not None:
+        key = Cache.key(source, tuple(args), BUILD_VERSION, mpy_cross_version())
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, name)
+        out = os.path.join(tmp, mpy_name(name))
+        with open(src, 'w') as f:
+            f.write(source)
+        p = subprocess.run([MPY_CROSS, '-s', name, '-o', out] + list(args) + [src], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            raise RuntimeError('mpy-cross failed on {}: {}'.format(name, p.stdout.decode('utf8')))
+        with open(out, 'rb') as f:
+            data = f.read()
+
+    if cache is not None:
+        cache.put(key, data)
+    return data
+
+
+def mpy_name(name):
+    return os.path.splitext(name)[0] + '.mpy'
+
+
+def build_mpy(path, config, args=(), cache=None):
+    """ Config substitution + cross compile of the file at path. Returns (original text, bytecode). """
+    with open(path, 'r') as f:
         original = f.read()
+    return original, compile_mpy(os.path.basename(path), optimize(original, config), args, cache)
+
+
+def mpy_report(paths, config, args=(), cache=None):
+    print('{:20} {:>8} {:>8} {:>8} {:>6}'.format('Module', 'Source', 'Minified', 'Bytecode', 'Ratio'))
+    for path in paths:
+        original, minified = build(path, config, cache)
+        _, mpy = build_mpy(path, config, args, cache)
+        print('{:20} {:8d} {:8d} {:8d} {:5.0f}%'.format(os.path.basename(path), len(original), len(minified), len(mpy), 100 * len(mpy) / len(original) if original else 0))
 
-        for k, v in config.items():
-            original = original.replace(k, v)
 
-        class Bunch:
-            def __init__(self, **kwds):
-                self.__dict__.update(kwds)
+def do(path, config, compress=False, cache=None, mpy_args=None):
+    name = os.path.basename(path)
 
-        minified = pyminifier.minification.minify(pyminifier.token_utils.listified_tokenizer(original), Bunch(tabs=False))
+    if mpy_args is not None:
+        original, mpy = build_mpy(path, config, mpy_args, cache)
+        print('# Original: {} Bytecode: {}'.format(len(original), len(mpy)))
+        for block in transfer(mpy_name(name), mpy, compress):
+            print(block)
+        return
 
-        # print(minified)
+    original, minified = build(path, config, cache)
 
-        print('# Original: {} Minified: {} Saved: {}'.format(len(original), len(minified), len(original) - len(minified)))
-        # print('import esp')
-        # print('import machine')
-        # print('esp.osdebug(None)')
-        # print('machine.freq(160000000)')
-        print('gc.collect()')
-        print('f = open("{}", "w")'.format(name))
+    # print(minified)
 
-        for part in re.findall('.{1,1000}', minified, re.DOTALL):
-            # print('f.write(d({!r}))'.format(zlib.compress(part.encode('ascii'), 9)))
-            print('f.write({!r})'.format(part))
+    print('# Original: {} Minified: {} Saved: {}'.format(len(original), len(minified), len(original) - len(minified)))
+    # print('import esp')
+    # print('import machine')
+    # print('esp.osdebug(None)')
+    # print('machine.freq(160000000)')
 
-        print('f.close()')
-        # print('machine.reset()')
+    for block in transfer(name, minified.encode('utf8'), compress):
+        print(block)
+
+    # print('machine.reset()')
 
 
 def main():
@@ -47,14 +473,34 @@ def main():
 
     parser.add_argument('files', nargs='+')
     parser.add_argument('--config', nargs='*', default=[])
+    parser.add_argument('--compress', action='store_true', help='Deflate + base64 (use paste mode, Ctrl-E)')
+    parser.add_argument('--bench', action='store_true', help='Only compare transfer sizes, upload nothing')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200, help='Baudrate used for the --bench time estimates')
+    parser.add_argument('--cache', default=CACHE_DIR, help='Build cache directory')
+    parser.add_argument('--cache-size', type=int, default=4096, help='Max build cache size in KB')
+    parser.add_argument('--no-cache', action='store_true', help='Always minify from scratch')
+    parser.add_argument('--mpy', action='store_true', help='Upload .mpy bytecode made by mpy-cross instead of minified source')
+    parser.add_argument('--mpy-args', nargs='*', default=[], help='Extra arguments for mpy-cross')
+    parser.add_argument('--mpy-report', action='store_true', help='Only compare source, minified and bytecode sizes, upload nothing')
 
     args = parser.parse_args()
 
+    if args.bench:
+        bench(args.files, args.baudrate)
+        return
+
     config = {}
     for file in args.config:
         config.update({k: v for k, v in vars(importlib.import_module(file)).items() if not k.startswith('__')})
+    cache = None if args.no_cache else Cache(args.cache, args.cache_size * 1024)
+    start = time.time()
+    if args.mpy_report:
+        mpy_report(args.files, config, args.mpy_args, cache)
+        return
     for file in args.files:
-        do(file, config)
+        do(file, config, args.compress, cache, args.mpy_args if args.mpy else None)
+    if cache is not None:
+        print('# {} in {:.2f}s'.format(cache.stats(), time.time() - start))
 
 if __name__ == '__main__':
     main()